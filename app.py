@@ -8,11 +8,21 @@ from datetime import datetime, timedelta
 
 from config import (
     CHANNEL,
+    TASK_INPROCESS_WORKERS,
     RAZORPAY_KEY_ID,
     RAZORPAY_KEY_SECRET,
     RAZORPAY_WEBHOOK_SECRET
 )
-from db import init_db, get_db
+from db import init_db, get_cursor, pool_stats
+from llm_client import warmup_llm, llm_stats
+from task_queue import start_task_workers, queue_stats
+from user_state import invalidate_user_state, user_state_stats
+from history_writer import history_stats
+from session_cache import session_stats
+from maya_engine import prompt_stats
+from whatsapp_client import whatsapp_stats
+from whatsapp_webhook import dedup_stats, inbound_dispatcher
+from stats_log import start_stats_log
 
 
 # -----------------------------
@@ -23,8 +33,27 @@ app = Flask(__name__)
 # Initialize DB
 init_db()
 
+# Open LLM keep-alive connections without delaying startup
+threading.Thread(target=warmup_llm, daemon=True).start()
+
+# memory extraction / summaries (more capacity: python task_queue.py)
+start_task_workers(TASK_INPROCESS_WORKERS)
+
 register_whatsapp_routes(app)
 
+start_stats_log({
+    "db_pool": pool_stats,
+    "history": history_stats,
+    "llm": llm_stats,
+    "session_cache": session_stats,
+    "user_state": user_state_stats,
+    "prompt": prompt_stats,
+    "task_queue": queue_stats,
+    "whatsapp_inbound": inbound_dispatcher.stats,
+    "whatsapp_dedup": dedup_stats,
+    "whatsapp_send": whatsapp_stats,
+})
+
 # -----------------------------
 # Health Check Route
 # -----------------------------
@@ -84,17 +113,6 @@ def razorpay_webhook():
 # -----------------------------
 def activate_subscription(platform, user_id, plan):
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    # Reset expired premium
-    cur.execute("""
-        UPDATE users
-        SET is_premium = FALSE
-        WHERE premium_expires_at IS NOT NULL
-        AND premium_expires_at < NOW()
-    """)
-
     if plan == "trial":
         expires = datetime.utcnow() + timedelta(days=3)
         subscription_type = "trial"
@@ -102,23 +120,36 @@ def activate_subscription(platform, user_id, plan):
         expires = datetime.utcnow() + timedelta(days=30)
         subscription_type = "monthly"
 
-    cur.execute("""
-        UPDATE users
-        SET is_premium = TRUE,
-            subscription_type = %s,
-            premium_expires_at = %s,
-            trial_used = CASE 
-                WHEN %s = 'trial' THEN TRUE
-                ELSE trial_used
-            END,
-            trial_expiry_notified = FALSE
-        WHERE platform = %s
-        AND platform_user_id = %s
-    """, (subscription_type, expires, subscription_type, platform, user_id))
-
-    conn.commit()
-    cur.close()
-    conn.close()
+    with get_cursor() as cur:
+
+        # Reset expired premium
+        cur.execute("""
+            UPDATE users
+            SET is_premium = FALSE
+            WHERE premium_expires_at IS NOT NULL
+            AND premium_expires_at < NOW()
+        """)
+
+        cur.execute("""
+            UPDATE users
+            SET is_premium = TRUE,
+                subscription_type = %s,
+                premium_expires_at = %s,
+                trial_used = CASE 
+                    WHEN %s = 'trial' THEN TRUE
+                    ELSE trial_used
+                END,
+                trial_expiry_notified = FALSE
+            WHERE platform = %s
+            AND platform_user_id = %s
+        """, (subscription_type, expires, subscription_type, platform, user_id))
+
+    # Cached premium flags are stale now: this user was upgraded and
+    # expired subscriptions were reset for everyone. This only reaches
+    # the webhook process; the bot's cache stays correct on its own
+    # (see user_state: free entries never serve threshold turns,
+    # premium entries end at premium_expires_at)
+    invalidate_user_state()
 
     print(f"Subscription activated for {user_id} ({subscription_type})")
 
@@ -0,0 +1,110 @@
+import os
+import sys
+import random
+import string
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from lexicon import Lexicon, DEFAULT_LEXICON
+
+
+# =====================================
+# KEYWORD SCAN: SUBSTRING LOOPS vs TRIE REGEX
+# Per-message cost of the old detect_crisis / interpret_message
+# substring scans (one `in` per phrase, per list) against one
+# Lexicon.scan, for the built-in lexicon and for lexicons grown
+# to thousands of phrases. Results are checked to agree first.
+#
+#   python bench/lexicon_scan.py [number]
+# =====================================
+
+MESSAGES = [
+    "hi",
+    "aaj bahut stress hai office mein, kya karu samajh nahi aa raha",
+    "I feel so lonely these days and honestly pretty tired of everything",
+    "nothing much, just had dinner and watching a movie with family tonight",
+    "mujhe lagta hai main kabhi khush nahi reh paunga, sab kuch bekaar lagta hai yaar " * 3,
+]
+
+
+def substring_scan(lexicon, text):
+
+    # The pre-lexicon code, generalised to any phrase lists
+    text = text.lower()
+
+    crisis = any(t in text for t in lexicon["crisis"])
+
+    emotion = None
+
+    for k, v in lexicon["emotion"].items():
+        if k in text:
+            emotion = v
+            break
+
+    advice = any(t in text for t in lexicon["advice"])
+    venting = any(w in text for w in lexicon["venting"])
+
+    return crisis, emotion, advice, venting
+
+
+def grown_lexicon(extra, seed=11):
+
+    # DEFAULT_LEXICON plus `extra` random phrases per list: the
+    # messages above rarely hit them, the worst case for substring scans
+    rng = random.Random(seed)
+
+    def phrase():
+        return " ".join(
+            "".join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8)))
+            for _ in range(rng.randint(1, 3))
+        )
+
+    return {
+        "crisis": DEFAULT_LEXICON["crisis"] + [phrase() for _ in range(extra)],
+        "emotion": {**DEFAULT_LEXICON["emotion"], **{phrase(): "sad" for _ in range(extra)}},
+        "advice": DEFAULT_LEXICON["advice"] + [phrase() for _ in range(extra)],
+        "venting": DEFAULT_LEXICON["venting"] + [phrase() for _ in range(extra)],
+    }
+
+
+def check(lexicon, compiled):
+
+    for text in MESSAGES:
+
+        m = compiled.scan(text)
+
+        assert (m.crisis, m.emotion, m.advice, m.venting) == substring_scan(lexicon, text), text
+
+
+def main():
+
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+
+    print(f"{len(MESSAGES)} messages x {number} runs, microseconds per message\n")
+
+    for label, lexicon in (
+        ("built-in", DEFAULT_LEXICON),
+        ("+1,000 per list", grown_lexicon(1000)),
+        ("+5,000 per list", grown_lexicon(5000)),
+    ):
+
+        compiled = Lexicon(lexicon)
+        check(lexicon, compiled)
+
+        phrases = len(compiled._implied)
+        runs = number if phrases < 1000 else max(number // 20, 10)
+
+        old = timeit.timeit(lambda: [substring_scan(lexicon, t) for t in MESSAGES], number=runs)
+        new = timeit.timeit(lambda: [compiled.scan(t) for t in MESSAGES], number=runs)
+
+        per = runs * len(MESSAGES)
+
+        print(
+            f"{label:16} {phrases:6} phrases   substring {old / per * 1e6:9.1f}us   "
+            f"lexicon {new / per * 1e6:7.1f}us   x{old / new:.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+import os
+import sys
+import time
+import random
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prompt_builder import PromptBuilder
+
+
+# =====================================
+# MEMORY CALLBACK: BEFORE / AFTER
+# Per-turn latency of the old path (an extra LLM call to write the
+# "remember this" line on ~25% of turns with memories and more than
+# 4 history rows, then the main call) against the precomputed
+# callback read from the user_memory row (main call only).
+# The LLM is a stub with a fixed latency, so the numbers isolate
+# the number of serial round trips.
+#
+#   python bench/memory_callback.py [turns] [llm_latency_ms]
+# =====================================
+
+CALLBACK_CHANCE = 0.25
+
+MEMORIES = [
+    (1, "has an exam on friday", "exam ki taiyari kaisi chal rahi hai?"),
+    (2, "fought with best friend", "dost ke saath sab theek hua?"),
+    (3, "started going to the gym", "gym ka scene kaisa chal raha hai?"),
+]
+
+HISTORY = [("user", "aaj bahut thak gaya"), ("assistant", "kya hua? din lamba tha?")] * 4
+
+
+class StubLLM:
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+
+    def __call__(self, messages):
+        self.calls += 1
+        time.sleep(self.latency)
+        return "haan yaar, samajh sakti hoon"
+
+
+def old_turn(llm, builder, rng):
+
+    callback = ""
+
+    if len(HISTORY) > 4 and rng.random() < CALLBACK_CHANCE:
+
+        _, memory, _ = rng.choice(MEMORIES)
+
+        callback = llm([{"role": "user", "content": (
+            "The user previously mentioned this fact:\n\n"
+            f"{memory}\n\n"
+            "Write ONE casual message remembering this."
+        )}]).strip()
+
+    prompt = builder.build("friend", [m[1] for m in MEMORIES], callback, "short", HISTORY, "hmm")
+
+    return llm(prompt.messages)
+
+
+def new_turn(llm, builder, rng):
+
+    callback = ""
+
+    if len(HISTORY) > 4 and rng.random() < CALLBACK_CHANCE:
+        _, _, callback = rng.choice(MEMORIES)
+
+    prompt = builder.build("friend", [m[1] for m in MEMORIES], callback, "short", HISTORY, "hmm")
+
+    return llm(prompt.messages)
+
+
+def run(turn, turns, latency, seed=7):
+
+    llm = StubLLM(latency)
+    builder = PromptBuilder("You are Maya.", {"friend": "be warm"}, 2500)
+    rng = random.Random(seed)
+
+    samples = []
+
+    for _ in range(turns):
+        started = time.perf_counter()
+        turn(llm, builder, rng)
+        samples.append((time.perf_counter() - started) * 1000)
+
+    samples.sort()
+
+    return {
+        "mean_ms": statistics.mean(samples),
+        "p50_ms": samples[len(samples) // 2],
+        "p95_ms": samples[int(len(samples) * 0.95) - 1],
+        "max_ms": samples[-1],
+        "llm_calls": llm.calls,
+    }
+
+
+def main():
+
+    turns = int(sys.argv[1]) if len(sys.argv) > 1 else 400
+    latency = float(sys.argv[2]) / 1000 if len(sys.argv) > 2 else 0.02
+
+    print(f"{turns} turns, stub LLM latency {latency * 1000:.0f}ms\n")
+
+    for name, turn in (("old (callback call + main)", old_turn), ("new (precomputed callback)", new_turn)):
+
+        r = run(turn, turns, latency)
+
+        print(
+            f"{name:28} mean {r['mean_ms']:7.1f}ms  p50 {r['p50_ms']:7.1f}ms  "
+            f"p95 {r['p95_ms']:7.1f}ms  max {r['max_ms']:7.1f}ms  llm calls {r['llm_calls']}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import time
+import asyncio
+import logging
+from collections import namedtuple
+from datetime import timedelta
+
+from psycopg2.extras import execute_values
+from telegram.error import RetryAfter, Forbidden, BadRequest, NetworkError
+
+from config import (
+    TELEGRAM_BROADCAST_RATE,
+    TELEGRAM_BROADCAST_CONCURRENCY,
+    TELEGRAM_PER_CHAT_INTERVAL,
+    BROADCAST_CHECKPOINT_DAYS
+)
+from db import get_cursor
+from job_runtime import run_blocking
+from rate_limit import TokenBucket
+
+
+# =====================================
+# TELEGRAM BROADCAST ENGINE
+# Fans a job's messages out concurrently under one global
+# token bucket plus a per-chat spacing, honours RetryAfter,
+# skips users who blocked the bot, and checkpoints every
+# delivery under a run key so a restarted job resumes
+# instead of messaging people twice.
+# =====================================
+
+BroadcastResult = namedtuple("BroadcastResult", [
+    "run_key",
+    "sent",
+    "failed",
+    "blocked",
+    "skipped",
+    "seconds",
+    "delivered",    # chat ids that received the message
+])
+
+SEND_ATTEMPTS = 3
+CHECKPOINT_BATCH = 200
+FETCH_CHUNK = 500
+
+telegram_bucket = TokenBucket(TELEGRAM_BROADCAST_RATE)
+
+_chat_ready_at = {}
+
+
+async def broadcast(bot, run_key, recipients, concurrency=TELEGRAM_BROADCAST_CONCURRENCY, on_checkpoint=None):
+
+    # recipients: iterable of (chat_id, text). It is consumed in
+    # chunks on the job executor, so it may lazily hit the DB.
+    # on_checkpoint(chat_ids): blocking hook run on the job executor
+    # for every delivered batch, just before it is checkpointed, so
+    # per-delivery side effects survive a restart mid-broadcast.
+
+    started = time.monotonic()
+
+    delivered_before = await run_blocking(_load_checkpoint, run_key)
+
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+    delivered = []
+    unsaved = []
+    counts = {"sent": 0, "failed": 0, "blocked": 0, "skipped": 0}
+
+    async def produce():
+
+        iterator = iter(recipients)
+
+        while True:
+
+            chunk = await run_blocking(_take, iterator, FETCH_CHUNK)
+
+            if not chunk:
+                break
+
+            for chat_id, text in chunk:
+
+                if str(chat_id) in delivered_before:
+                    counts["skipped"] += 1
+                    continue
+
+                await queue.put((chat_id, text))
+
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def consume():
+
+        while True:
+
+            item = await queue.get()
+
+            if item is None:
+                return
+
+            chat_id, text = item
+            outcome = await send_with_limits(bot, chat_id, text)
+            counts[outcome] += 1
+
+            if outcome != "sent":
+                continue
+
+            delivered.append(str(chat_id))
+            unsaved.append(str(chat_id))
+
+            if len(unsaved) >= CHECKPOINT_BATCH:
+                batch = unsaved[:]
+                unsaved.clear()
+                await run_blocking(_save_checkpoint, run_key, batch, on_checkpoint)
+
+            done = counts["sent"] + counts["failed"] + counts["blocked"]
+
+            if done % 1000 == 0:
+                _log_progress(run_key, counts, started)
+
+    workers = [asyncio.create_task(consume()) for _ in range(concurrency)]
+
+    try:
+        await produce()
+        await asyncio.gather(*workers)
+    finally:
+        for w in workers:
+            w.cancel()
+        if unsaved:
+            await run_blocking(_save_checkpoint, run_key, unsaved, on_checkpoint)
+
+    result = BroadcastResult(
+        run_key=run_key,
+        seconds=time.monotonic() - started,
+        delivered=delivered,
+        **counts
+    )
+
+    _log_progress(run_key, counts, started, final=True)
+
+    return result
+
+
+async def send_with_limits(bot, chat_id, text):
+
+    for attempt in range(SEND_ATTEMPTS):
+
+        await telegram_bucket.acquire_async()
+        await _wait_for_chat(chat_id)
+
+        try:
+
+            await bot.send_message(chat_id=chat_id, text=text)
+            return "sent"
+
+        except RetryAfter as e:
+            # The penalty holds every sender back; the next
+            # acquire_async() does the waiting
+            telegram_bucket.penalize(_seconds(e.retry_after))
+
+        except Forbidden:
+            # user blocked the bot / deactivated
+            return "blocked"
+
+        except BadRequest as e:
+            logging.error("Broadcast to %s rejected: %s", chat_id, e)
+            return "failed"
+
+        except NetworkError as e:
+            logging.warning("Broadcast to %s failed (attempt %s): %s", chat_id, attempt + 1, e)
+            await asyncio.sleep(2 ** attempt)
+
+        except Exception as e:
+            logging.error("Broadcast to %s failed: %s", chat_id, e)
+            return "failed"
+
+    return "failed"
+
+
+async def _wait_for_chat(chat_id):
+
+    now = time.monotonic()
+    ready_at = _chat_ready_at.get(chat_id, 0.0)
+
+    _chat_ready_at[chat_id] = max(now, ready_at) + TELEGRAM_PER_CHAT_INTERVAL
+
+    if len(_chat_ready_at) > 50000:
+        for key in [k for k, t in _chat_ready_at.items() if t < now]:
+            del _chat_ready_at[key]
+
+    if ready_at > now:
+        await asyncio.sleep(ready_at - now)
+
+
+def _seconds(value):
+
+    if isinstance(value, timedelta):
+        return value.total_seconds()
+
+    return float(value)
+
+
+def _take(iterator, n):
+
+    chunk = []
+
+    for item in iterator:
+
+        chunk.append(item)
+
+        if len(chunk) >= n:
+            break
+
+    return chunk
+
+
+def _load_checkpoint(run_key):
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            DELETE FROM broadcast_deliveries
+            WHERE sent_at < NOW() - %s
+        """, (timedelta(days=BROADCAST_CHECKPOINT_DAYS),))
+
+        cur.execute("""
+            SELECT chat_id
+            FROM broadcast_deliveries
+            WHERE run_key=%s
+        """, (run_key,))
+
+        return {r[0] for r in cur.fetchall()}
+
+
+def _save_checkpoint(run_key, chat_ids, on_checkpoint=None):
+
+    if on_checkpoint is not None:
+        try:
+            on_checkpoint(chat_ids)
+        except Exception as e:
+            logging.error("Broadcast %s checkpoint hook failed: %s", run_key, e)
+
+    try:
+
+        with get_cursor() as cur:
+
+            execute_values(cur, """
+                INSERT INTO broadcast_deliveries (run_key, chat_id)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+            """, [(run_key, c) for c in chat_ids])
+
+    except Exception as e:
+        logging.error("Broadcast checkpoint for %s failed: %s", run_key, e)
+
+
+def _log_progress(run_key, counts, started, final=False):
+
+    elapsed = time.monotonic() - started
+    done = counts["sent"] + counts["failed"] + counts["blocked"]
+
+    logging.info(
+        "Broadcast %s %s: sent=%s failed=%s blocked=%s skipped=%s in %.1fs (%.1f msg/s)",
+        run_key,
+        "finished" if final else "progress",
+        counts["sent"],
+        counts["failed"],
+        counts["blocked"],
+        counts["skipped"],
+        elapsed,
+        done / elapsed if elapsed > 0 else 0.0
+    )
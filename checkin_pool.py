@@ -0,0 +1,188 @@
+import time
+import zlib
+import logging
+import threading
+from collections import OrderedDict, deque
+from datetime import date
+
+from psycopg2.extras import execute_values
+
+from config import (
+    CHECKIN_POOL_SIZE,
+    CHECKIN_NO_REPEAT,
+    CHECKIN_REFRESH_INTERVAL,
+    CHECKIN_TRACKED_USERS
+)
+from db import get_cursor
+from maya_engine import CHECKIN_PROMPTS, CHECKIN_FALLBACKS, generate_checkin_batch
+
+
+# =====================================
+# CHECK-IN MESSAGE POOL
+# One batched LLM call fills a category with K variants
+# (stored in checkin_pool). Broadcasts only pick from it,
+# never calling the LLM per recipient.
+# =====================================
+
+class CheckinPool:
+
+    def __init__(self, size, no_repeat, tracked_users, max_age):
+
+        self.size = size
+        self.no_repeat = no_repeat
+        self.tracked_users = tracked_users
+        self.max_age = max_age
+
+        self._messages = {}         # category -> [(id, message)]
+        self._newest_at = {}        # category -> monotonic time of the newest variant
+        self._recent = OrderedDict()    # (category, user_id) -> deque of ids, LRU
+        self._lock = threading.Lock()
+
+    def load(self, category):
+
+        with get_cursor() as cur:
+
+            cur.execute("""
+                SELECT id, message, EXTRACT(EPOCH FROM NOW() - created_at)
+                FROM checkin_pool
+                WHERE category=%s
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, (category, self.size))
+
+            rows = cur.fetchall()
+
+        with self._lock:
+            self._messages[category] = [(r[0], r[1]) for r in rows]
+            self._newest_at[category] = time.monotonic() - float(rows[0][2]) if rows else None
+
+        return len(rows)
+
+    def refresh(self, category, force=False):
+
+        if category not in self._messages:
+            self.load(category)
+
+        age = self._age(category)
+
+        if not force and age is not None and age < self.max_age:
+            return 0
+
+        variants = generate_checkin_batch(category, self.size)
+
+        if not variants:
+            logging.warning("Check-in pool refresh for %s produced nothing", category)
+            return 0
+
+        with get_cursor() as cur:
+
+            execute_values(cur, """
+                INSERT INTO checkin_pool (category, message)
+                VALUES %s
+            """, [(category, v) for v in variants])
+
+            # Keep a couple of older generations, drop the rest
+            cur.execute("""
+                DELETE FROM checkin_pool
+                WHERE category=%s
+                AND id NOT IN (
+                    SELECT id
+                    FROM checkin_pool
+                    WHERE category=%s
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT %s
+                )
+            """, (category, category, self.size * 3))
+
+        self.load(category)
+
+        return len(variants)
+
+    def pick(self, category, user_id):
+
+        if category not in self._messages:
+            self.load(category)
+
+        with self._lock:
+
+            messages = self._messages[category]
+
+            if not messages:
+                return CHECKIN_FALLBACKS[category]
+
+            key = (category, str(user_id))
+
+            recent = self._recent.pop(key, None)
+
+            if recent is None:
+                recent = deque(maxlen=self.no_repeat)
+
+            self._recent[key] = recent
+
+            if len(self._recent) > self.tracked_users:
+                self._recent.popitem(last=False)
+
+            # Per-user, per-day starting point spreads one broadcast
+            # across the pool and rotates users through it day by day
+            start = (zlib.crc32(key[1].encode()) + date.today().toordinal()) % len(messages)
+
+            for i in range(len(messages)):
+
+                message_id, message = messages[(start + i) % len(messages)]
+
+                if message_id not in recent:
+                    break
+
+            else:
+                message_id, message = messages[start]
+
+            recent.append(message_id)
+
+        return message
+
+    def _age(self, category):
+
+        # Current age, not the age seen when the pool was loaded
+        with self._lock:
+            return self._age_locked(category)
+
+    def _age_locked(self, category):
+
+        newest_at = self._newest_at.get(category)
+
+        return None if newest_at is None else time.monotonic() - newest_at
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                "categories": {c: len(m) for c, m in self._messages.items()},
+                "age_seconds": {c: self._age_locked(c) for c in self._newest_at},
+                "tracked_users": len(self._recent),
+            }
+
+
+checkin_pool = CheckinPool(
+    CHECKIN_POOL_SIZE,
+    CHECKIN_NO_REPEAT,
+    CHECKIN_TRACKED_USERS,
+    CHECKIN_REFRESH_INTERVAL
+)
+
+
+def refresh_checkin_pools(force=False):
+
+    for category in CHECKIN_PROMPTS:
+
+        try:
+            added = checkin_pool.refresh(category, force=force)
+        except Exception as e:
+            logging.error("Check-in pool refresh for %s failed: %s", category, e)
+            continue
+
+        if added:
+            logging.info("Check-in pool %s refreshed with %s messages", category, added)
+
+
+def pick_checkin(category, user_id):
+    return checkin_pool.pick(category, user_id)
@@ -8,6 +8,21 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 
 # AI
 OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
+LLM_BASE_URL = os.getenv("LLM_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "10"))
+LLM_WARMUP_CONNECTIONS = int(os.getenv("LLM_WARMUP_CONNECTIONS", "2"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "30"))
+
+# Model routing: tried in order, fallback hedged after LLM_HEDGE_DELAY
+LLM_MODELS = [m.strip() for m in os.getenv(
+    "LLM_MODELS",
+    "arcee-ai/trinity-large-preview:free,meta-llama/llama-3.2-3b-instruct:free"
+).split(",") if m.strip()]
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "4"))
+LLM_DEADLINE = float(os.getenv("LLM_DEADLINE", "20"))
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "3"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "60"))
 
 # Database
 DATABASE_URL = os.getenv("DATABASE_URL")
@@ -24,3 +39,99 @@ PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 RAZORPAY_KEY_ID = os.getenv("RAZORPAY_KEY_ID")
 RAZORPAY_KEY_SECRET = os.getenv("RAZORPAY_KEY_SECRET")
 RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET")
+
+# Database pool (per process)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_CHECK_IDLE = float(os.getenv("DB_POOL_CHECK_IDLE", "30"))
+
+# Async pool (psycopg 3) used by the asyncio engine path
+DB_ASYNC_POOL_MIN = int(os.getenv("DB_ASYNC_POOL_MIN", "1"))
+DB_ASYNC_POOL_MAX = int(os.getenv("DB_ASYNC_POOL_MAX", "20"))
+
+# Conversation history write-behind buffer
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "200"))
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "0.5"))
+HISTORY_QUEUE_MAX = int(os.getenv("HISTORY_QUEUE_MAX", "10000"))
+
+# Check-in message pools
+CHECKIN_POOL_SIZE = int(os.getenv("CHECKIN_POOL_SIZE", "20"))
+CHECKIN_NO_REPEAT = int(os.getenv("CHECKIN_NO_REPEAT", "7"))
+CHECKIN_REFRESH_INTERVAL = int(os.getenv("CHECKIN_REFRESH_INTERVAL", "21600"))
+CHECKIN_TRACKED_USERS = int(os.getenv("CHECKIN_TRACKED_USERS", "100000"))
+
+# Background task queue
+TASK_WORKER_THREADS = int(os.getenv("TASK_WORKER_THREADS", "2"))
+TASK_INPROCESS_WORKERS = int(os.getenv("TASK_INPROCESS_WORKERS", "1"))
+TASK_POLL_INTERVAL = float(os.getenv("TASK_POLL_INTERVAL", "1"))
+TASK_MAX_ATTEMPTS = int(os.getenv("TASK_MAX_ATTEMPTS", "3"))
+TASK_RETRY_BACKOFF = float(os.getenv("TASK_RETRY_BACKOFF", "30"))
+TASK_VISIBILITY_TIMEOUT = int(os.getenv("TASK_VISIBILITY_TIMEOUT", "300"))
+TASK_RETENTION_DAYS = int(os.getenv("TASK_RETENTION_DAYS", "7"))
+
+# WhatsApp inbound processing
+WHATSAPP_WORKERS = int(os.getenv("WHATSAPP_WORKERS", "8"))
+WHATSAPP_QUEUE_SIZE = int(os.getenv("WHATSAPP_QUEUE_SIZE", "1000"))
+
+# Inbound message idempotency
+DEDUP_LRU_SIZE = int(os.getenv("DEDUP_LRU_SIZE", "50000"))
+DEDUP_TTL_HOURS = int(os.getenv("DEDUP_TTL_HOURS", "48"))
+DEDUP_CLEANUP_INTERVAL = int(os.getenv("DEDUP_CLEANUP_INTERVAL", "3600"))
+
+# WhatsApp outbound (Cloud API per-number throughput). Rate and burst
+# are for the whole number and split evenly across the processes that
+# send (gunicorn workers; WEB_CONCURRENCY is gunicorn's own setting)
+WHATSAPP_SEND_RATE = float(os.getenv("WHATSAPP_SEND_RATE", "80"))
+WHATSAPP_SEND_BURST = float(os.getenv("WHATSAPP_SEND_BURST", "80"))
+WHATSAPP_SEND_PROCESSES = int(os.getenv("WHATSAPP_SEND_PROCESSES", os.getenv("WEB_CONCURRENCY", "1")))
+WHATSAPP_SEND_RETRIES = int(os.getenv("WHATSAPP_SEND_RETRIES", "3"))
+WHATSAPP_POOL_SIZE = int(os.getenv("WHATSAPP_POOL_SIZE", "20"))
+WHATSAPP_CONNECT_TIMEOUT = float(os.getenv("WHATSAPP_CONNECT_TIMEOUT", "5"))
+WHATSAPP_READ_TIMEOUT = float(os.getenv("WHATSAPP_READ_TIMEOUT", "15"))
+
+# Telegram updates handled at once by the bot (PTB's default is one)
+TELEGRAM_CONCURRENT_UPDATES = int(os.getenv("TELEGRAM_CONCURRENT_UPDATES", "256"))
+
+# Telegram broadcasts (global limit is ~30 msg/s)
+TELEGRAM_BROADCAST_RATE = float(os.getenv("TELEGRAM_BROADCAST_RATE", "25"))
+TELEGRAM_BROADCAST_CONCURRENCY = int(os.getenv("TELEGRAM_BROADCAST_CONCURRENCY", "20"))
+TELEGRAM_PER_CHAT_INTERVAL = float(os.getenv("TELEGRAM_PER_CHAT_INTERVAL", "1"))
+BROADCAST_CHECKPOINT_DAYS = int(os.getenv("BROADCAST_CHECKPOINT_DAYS", "7"))
+
+# Missed daily check-ins are rerun at startup if their slot passed
+# less than this many hours ago
+CHECKIN_CATCH_UP_HOURS = float(os.getenv("CHECKIN_CATCH_UP_HOURS", "3"))
+
+# Keyword lexicon: optional JSON file with extra crisis / emotion /
+# advice / venting phrases merged over the built-in lists
+LEXICON_PATH = os.getenv("LEXICON_PATH")
+
+# Prompt size limit per LLM call (locally estimated tokens)
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+
+# Hot per-user session cache (recent turns + memories, per process)
+SESSION_CACHE_BYTES = int(os.getenv("SESSION_CACHE_BYTES", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL = int(os.getenv("SESSION_CACHE_TTL", "900"))
+
+# Quota / premium state cache (per process, reconciled in batches)
+USER_STATE_TTL = int(os.getenv("USER_STATE_TTL", "300"))
+USER_STATE_MAX_ENTRIES = int(os.getenv("USER_STATE_MAX_ENTRIES", "100000"))
+USER_STATE_FLUSH_INTERVAL = float(os.getenv("USER_STATE_FLUSH_INTERVAL", "5"))
+USER_STATE_SYNC_MARGIN = int(os.getenv("USER_STATE_SYNC_MARGIN", "2"))
+# Platforms whose turns are all served by ONE process (Telegram long
+# polling is single-consumer by design); only these count locally.
+# Leave a platform out when it runs behind several workers.
+USER_STATE_LOCAL_PLATFORMS = [p.strip() for p in os.getenv(
+    "USER_STATE_LOCAL_PLATFORMS",
+    "telegram"
+).split(",") if p.strip()]
+
+# Scheduled jobs: bounded executor for blocking work, event-loop lag probe
+JOB_EXECUTOR_WORKERS = int(os.getenv("JOB_EXECUTOR_WORKERS", "4"))
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_LAG_WARN_MS = float(os.getenv("LOOP_LAG_WARN_MS", "200"))
+
+# Runtime stats (pools, caches, queues, LLM, senders) logged by the
+# bot and the web app every this many seconds; 0 turns it off
+STATS_LOG_INTERVAL = int(os.getenv("STATS_LOG_INTERVAL", "300"))
@@ -1,15 +1,594 @@
+import os
+import re
+import time
+import asyncio
+import threading
+import logging
+import weakref
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
 import psycopg2
-from config import DATABASE_URL
+from psycopg2 import extensions
+from psycopg_pool import AsyncConnectionPool
+
+from config import (
+    DATABASE_URL,
+    DB_POOL_MIN,
+    DB_POOL_MAX,
+    DB_POOL_TIMEOUT,
+    DB_POOL_CHECK_IDLE,
+    DB_ASYNC_POOL_MIN,
+    DB_ASYNC_POOL_MAX
+)
 
 
 def get_db():
     return psycopg2.connect(DATABASE_URL, sslmode="require")
 
 
+# ============================
+# CONNECTION POOL
+# ============================
+
+class PoolTimeout(psycopg2.OperationalError):
+    pass
+
+
+class ConnectionPool:
+
+    def __init__(self, minconn, maxconn, timeout, check_idle, connect=get_db):
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.pid = os.getpid()
+
+        self._connect = connect
+        self._idle = deque()        # (conn, returned_at), most recent last
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+        self._stats = {
+            "checkouts": 0,
+            "created": 0,
+            "reused": 0,
+            "discarded": 0,
+            "waits": 0,
+            "timeouts": 0,
+        }
+
+    def warmup(self):
+
+        opened = []
+
+        with self._cond:
+            missing = max(0, self.minconn - self._size)
+            self._size += missing
+
+        for _ in range(missing):
+            try:
+                opened.append(self._open())
+            except Exception as e:
+                logging.error("DB pool warmup failed: %s", e)
+                break
+
+        with self._cond:
+            self._size -= missing - len(opened)
+            now = time.monotonic()
+            for conn in opened:
+                self._idle.append((conn, now))
+            self._cond.notify_all()
+
+    def getconn(self):
+
+        deadline = time.monotonic() + self.timeout
+
+        with self._cond:
+
+            while not self._idle and self._size >= self.maxconn:
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(
+                        f"no free DB connection after {self.timeout}s "
+                        f"(max {self.maxconn})"
+                    )
+
+                self._stats["waits"] += 1
+                self._cond.wait(remaining)
+
+            if self._idle:
+                conn, returned_at = self._idle.pop()
+            else:
+                conn, returned_at = None, None
+                self._size += 1
+
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+
+        try:
+
+            if conn is not None and not self._healthy(conn, returned_at):
+                self._close(conn)
+                conn = None
+
+            if conn is None:
+                conn = self._open()
+            else:
+                self._count("reused")
+
+            return conn
+
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def putconn(self, conn, discard=False):
+
+        # Connections inherited over fork() belong to the parent
+        if os.getpid() != self.pid:
+            return
+
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except Exception:
+                discard = True
+
+        with self._cond:
+
+            self._in_use -= 1
+
+            if discard or conn.closed:
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+
+            self._cond.notify()
+
+        if discard or conn.closed:
+            self._close(conn)
+
+    def stats(self):
+
+        with self._cond:
+            return {
+                "pid": self.pid,
+                "size": self._size,
+                "idle": len(self._idle),
+                "in_use": self._in_use,
+                "max": self.maxconn,
+                **self._stats,
+            }
+
+    def _open(self):
+
+        conn = self._connect()
+        self._count("created")
+        return conn
+
+    def _close(self, conn):
+
+        self._count("discarded")
+
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _healthy(self, conn, returned_at):
+
+        if conn.closed:
+            return False
+
+        # Only ping connections that sat idle long enough to have been
+        # dropped by the server or a proxy in between
+        if time.monotonic() - returned_at < self.check_idle:
+            return True
+
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except Exception:
+            return False
+
+    def _count(self, key):
+
+        with self._cond:
+            self._stats[key] += 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_orphaned_pools = []
+
+
+def get_pool():
+
+    global _pool
+
+    pool = _pool
+
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+
+    with _pool_lock:
+
+        if _pool is None or _pool.pid != os.getpid():
+
+            # Keep the parent's pool referenced after a fork so its sockets
+            # are not closed (and the parent's sessions terminated) on GC
+            if _pool is not None:
+                _orphaned_pools.append(_pool)
+
+            _pool = ConnectionPool(
+                DB_POOL_MIN,
+                DB_POOL_MAX,
+                DB_POOL_TIMEOUT,
+                DB_POOL_CHECK_IDLE
+            )
+            _pool.warmup()
+
+        return _pool
+
+
+@contextmanager
+def get_conn():
+
+    pool = get_pool()
+    conn = pool.getconn()
+
+    try:
+        yield conn
+        conn.commit()
+    finally:
+        pool.putconn(conn)
+
+
+@contextmanager
+def get_cursor():
+
+    with get_conn() as conn:
+
+        cur = conn.cursor()
+
+        try:
+            yield cur
+        finally:
+            cur.close()
+
+
+def pool_stats():
+    return get_pool().stats()
+
+
+# ============================
+# ASYNC POOL (psycopg 3)
+# For the asyncio engine path. Same SQL as the sync side
+# (%s / %(name)s placeholders); one pool per event loop.
+# ============================
+
+_async_pools = weakref.WeakKeyDictionary()
+
+
+async def get_async_pool():
+
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+
+    if pool is None:
+
+        pool = AsyncConnectionPool(
+            DATABASE_URL,
+            min_size=DB_ASYNC_POOL_MIN,
+            max_size=DB_ASYNC_POOL_MAX,
+            timeout=DB_POOL_TIMEOUT,
+            kwargs={"sslmode": "require"},
+            open=False
+        )
+        _async_pools[loop] = pool
+
+        await pool.open()
+
+    return pool
+
+
+@asynccontextmanager
+async def get_async_cursor():
+
+    # Commits on success, rolls back on error (like get_conn)
+    pool = await get_async_pool()
+
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            yield cur
+
+
+def async_pool_stats():
+
+    return {
+        id(loop): pool.get_stats()
+        for loop, pool in list(_async_pools.items())
+    }
+
+
+# ============================
+# SCHEMA MIGRATIONS
+# Append only: each step runs once, in order, and is
+# recorded in schema_migrations. Statements run in autocommit
+# (CREATE INDEX CONCURRENTLY cannot run in a transaction block),
+# so each one must be safe to re-run after a partial failure.
+# Indexes on tables that already hold data are built
+# CONCURRENTLY, without blocking writes.
+# ============================
+
+MIGRATIONS = [
+
+    (1, "per-user lookup indexes", [
+
+        # turn context history / extract_user_memory / summaries
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_history_user_time
+        ON conversation_history (platform, platform_user_id, created_at DESC)
+        """,
+
+        # turn context memories
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_memory_user_time
+        ON user_memory (platform, platform_user_id, created_at DESC)
+        """,
+
+        # weekly mood summary (per user, and the weekly range scan)
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_mood_user_time
+        ON mood_logs (platform, platform_user_id, created_at DESC)
+        """,
+
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_mood_platform_time
+        ON mood_logs (platform, created_at)
+        """,
+
+        # expired premium reset in activate_subscription
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_premium_expiry
+        ON users (premium_expires_at)
+        WHERE premium_expires_at IS NOT NULL
+        """,
+
+        # scheduled telegram jobs (silence / check-ins / followups)
+        """
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_users_telegram_last_active
+        ON users (last_active)
+        WHERE platform = 'telegram'
+        """,
+    ]),
+
+    (2, "check-in message pool", [
+
+        """
+        CREATE TABLE IF NOT EXISTS checkin_pool (
+            id SERIAL PRIMARY KEY,
+            category TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        """,
+
+        """
+        CREATE INDEX IF NOT EXISTS idx_checkin_pool_category_time
+        ON checkin_pool (category, created_at DESC)
+        """,
+    ]),
+
+    (3, "background task queue", [
+
+        """
+        CREATE TABLE IF NOT EXISTS background_tasks (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            dedup_key TEXT NOT NULL,
+            payload JSONB NOT NULL DEFAULT '{}',
+            status TEXT NOT NULL DEFAULT 'pending',     -- pending / running / done / failed
+            attempts INT NOT NULL DEFAULT 0,
+            run_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            last_error TEXT
+        )
+        """,
+
+        # at most one pending task per (kind, key), e.g. per user
+        """
+        CREATE UNIQUE INDEX IF NOT EXISTS uq_background_tasks_pending
+        ON background_tasks (kind, dedup_key)
+        WHERE status = 'pending'
+        """,
+
+        """
+        CREATE INDEX IF NOT EXISTS idx_background_tasks_due
+        ON background_tasks (run_at)
+        WHERE status = 'pending'
+        """,
+
+        """
+        CREATE INDEX IF NOT EXISTS idx_background_tasks_running
+        ON background_tasks (started_at)
+        WHERE status = 'running'
+        """,
+    ]),
+
+    (4, "precomputed memory callbacks", [
+
+        """
+        ALTER TABLE user_memory
+        ADD COLUMN IF NOT EXISTS callback TEXT
+        """,
+    ]),
+
+    (5, "inbound message idempotency", [
+
+        """
+        CREATE TABLE IF NOT EXISTS processed_messages (
+            platform TEXT NOT NULL,
+            message_id TEXT NOT NULL,
+            seen_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (platform, message_id)
+        )
+        """,
+
+        """
+        CREATE INDEX IF NOT EXISTS idx_processed_messages_seen_at
+        ON processed_messages (seen_at)
+        """,
+    ]),
+
+    (6, "broadcast checkpoints", [
+
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            run_key TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            sent_at TIMESTAMP NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (run_key, chat_id)
+        )
+        """,
+
+        """
+        CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_sent_at
+        ON broadcast_deliveries (sent_at)
+        """,
+    ]),
+
+    (7, "whatsapp users already onboarded", [
+
+        # WhatsApp never showed the intro nor set the flag before the
+        # engine did; every existing row is someone already chatting
+        """
+        UPDATE users
+        SET onboarding_completed = TRUE
+        WHERE platform = 'whatsapp'
+        AND onboarding_completed IS DISTINCT FROM TRUE
+        """,
+    ]),
+]
+
+
+MIGRATION_LOCK_POLL = 1.0
+
+
 def init_db():
+
+    with get_cursor() as cur:
+        _create_tables(cur)
+
+    # Own connection, not a pooled one: it runs in autocommit and
+    # may sit in a long index build
     conn = get_db()
+
+    try:
+        _apply_migrations(conn)
+    finally:
+        conn.close()
+
+
+def _apply_migrations(conn):
+
+    conn.autocommit = True
     cur = conn.cursor()
 
+    # Serialize concurrent init_db calls (gunicorn workers, bot + web).
+    # Polled rather than waited on: a session blocked inside
+    # pg_advisory_lock keeps a snapshot open, and CREATE INDEX
+    # CONCURRENTLY in the lock holder would wait for it forever
+    while True:
+
+        cur.execute("SELECT pg_try_advisory_lock(hashtext('maya_schema_migrations'))")
+
+        if cur.fetchone()[0]:
+            break
+
+        time.sleep(MIGRATION_LOCK_POLL)
+
+    try:
+
+        cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INT PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT NOW()
+        );
+        """)
+
+        cur.execute("SELECT version FROM schema_migrations")
+
+        applied = {r[0] for r in cur.fetchall()}
+
+        for version, description, statements in MIGRATIONS:
+
+            if version in applied:
+                continue
+
+            for statement in statements:
+                _drop_invalid_index(cur, statement)
+                cur.execute(statement)
+
+            cur.execute("""
+                INSERT INTO schema_migrations (version, description)
+                VALUES (%s,%s)
+            """, (version, description))
+
+            logging.info("Applied schema migration %s: %s", version, description)
+
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext('maya_schema_migrations'))")
+        cur.close()
+
+
+_CONCURRENT_INDEX = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)",
+    re.IGNORECASE
+)
+
+
+def _drop_invalid_index(cur, statement):
+
+    # A failed concurrent build leaves an INVALID index behind, which
+    # IF NOT EXISTS would then happily skip
+    match = _CONCURRENT_INDEX.search(statement)
+
+    if match is None:
+        return
+
+    cur.execute("""
+        SELECT 1
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = %s
+        AND pg_table_is_visible(c.oid)
+        AND NOT i.indisvalid
+    """, (match.group(1),))
+
+    if cur.fetchone():
+        logging.warning("Rebuilding invalid index %s", match.group(1))
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {match.group(1)}")
+
+
+def _create_tables(cur):
+
     # ============================
     # USERS TABLE (Multi-platform ready)
     # ============================
@@ -84,7 +663,3 @@ def init_db():
         created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
     );
     """)
-
-    conn.commit()
-    cur.close()
-    conn.close()
@@ -0,0 +1,272 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+
+from psycopg2.extras import execute_values
+
+from config import HISTORY_FLUSH_SIZE, HISTORY_FLUSH_INTERVAL, HISTORY_QUEUE_MAX
+from db import get_cursor
+
+
+# =====================================
+# WRITE-BEHIND CONVERSATION HISTORY
+# Turns are queued in memory and written by one background
+# thread in multi-row inserts. created_at is stamped (strictly
+# increasing) at enqueue time, so per-user order survives batching.
+# =====================================
+
+class HistoryWriter:
+
+    def __init__(self, flush_size, flush_interval, max_queue):
+
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+
+        self._cond = threading.Condition()
+        self._pending = deque()     # (platform, user_id, role, message, created_at)
+        self._enqueued_at = deque()
+        self._flushing = False
+        self._force = False
+        self._closed = False
+        self._overflowing = False   # one error log per full-buffer episode
+        self._thread = None
+        self._pid = None
+        self._last_ts = datetime.min
+
+        self._stats = {
+            "enqueued": 0,
+            "flushed": 0,
+            "batches": 0,
+            "failures": 0,
+            "dropped": 0,
+            "last_flush_ms": 0.0,
+            "max_flush_ms": 0.0,
+            "total_flush_ms": 0.0,
+            "max_queue_wait_ms": 0.0,
+        }
+
+    def append(self, platform, user_id, role, message, block=True):
+
+        # block=False is for callers on an event loop: a full buffer
+        # drops the row (logged, counted) instead of stalling the loop.
+        # Returns False when the row was dropped
+        with self._cond:
+
+            self._ensure_started()
+
+            if len(self._pending) >= self.max_queue:
+
+                self._cond.notify_all()
+
+                if not block:
+
+                    self._stats["dropped"] += 1
+
+                    if not self._overflowing:
+                        self._overflowing = True
+                        logging.error("History buffer full (%s rows), dropping new rows", self.max_queue)
+
+                    return False
+
+                logging.warning("History buffer full (%s rows), waiting for flush", self.max_queue)
+
+            while len(self._pending) >= self.max_queue and not self._closed:
+                self._cond.notify_all()
+                self._cond.wait(self.flush_interval)
+
+            created_at = max(datetime.utcnow(), self._last_ts + timedelta(microseconds=1))
+            self._last_ts = created_at
+
+            self._pending.append((platform, user_id, role, message, created_at))
+            self._enqueued_at.append(time.monotonic())
+            self._stats["enqueued"] += 1
+
+            if len(self._pending) >= self.flush_size:
+                self._cond.notify_all()
+
+            return True
+
+    def flush(self, timeout=None):
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+
+            if self._closed or self._thread is None:
+                self._drain_locked()
+                return
+
+            self._force = True
+            self._cond.notify_all()
+
+            while self._pending or self._flushing:
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+
+                if remaining is not None and remaining <= 0:
+                    return
+
+                self._cond.wait(remaining)
+
+    def close(self):
+
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+
+        if thread is not None and thread.is_alive():
+            thread.join(timeout=30)
+
+        with self._cond:
+            self._drain_locked()
+
+    def stats(self):
+
+        with self._cond:
+
+            oldest = self._enqueued_at[0] if self._enqueued_at else None
+            batches = self._stats["batches"]
+
+            return {
+                "queue_depth": len(self._pending),
+                "oldest_pending_ms": 0.0 if oldest is None else (time.monotonic() - oldest) * 1000,
+                "avg_flush_ms": self._stats["total_flush_ms"] / batches if batches else 0.0,
+                **self._stats,
+            }
+
+    def _ensure_started(self):
+
+        # A forked child must not re-write rows queued by its parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._pending.clear()
+            self._enqueued_at.clear()
+            self._flushing = False
+            self._thread = None
+
+        if self._thread is None and not self._closed:
+            self._thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+
+        with self._cond:
+
+            while True:
+
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+
+                if not self._pending:
+                    return
+
+                # Flush on size, on age of the oldest row, or on shutdown
+                deadline = self._enqueued_at[0] + self.flush_interval
+
+                while (
+                    len(self._pending) < self.flush_size
+                    and not self._closed
+                    and not self._force
+                    and time.monotonic() < deadline
+                ):
+                    self._cond.wait(deadline - time.monotonic())
+
+                if self._flush_batch_locked():
+
+                    if not self._pending:
+                        self._force = False
+
+                elif self._closed:
+                    return
+
+                else:
+                    self._cond.wait(self.flush_interval)
+
+    def _drain_locked(self):
+
+        while self._flushing:
+            self._cond.wait()
+
+        while self._pending:
+            if not self._flush_batch_locked():
+                logging.error("Dropping %s unsaved history rows", len(self._pending))
+                return
+
+    def _flush_batch_locked(self):
+
+        count = min(len(self._pending), self.flush_size)
+        batch = [self._pending[i] for i in range(count)]
+        oldest = self._enqueued_at[0]
+
+        self._flushing = True
+        self._cond.release()
+
+        started = time.monotonic()
+
+        try:
+
+            with get_cursor() as cur:
+
+                execute_values(cur, """
+                    INSERT INTO conversation_history
+                    (platform, platform_user_id, role, message, created_at)
+                    VALUES %s
+                """, batch, page_size=len(batch))
+
+            ok = True
+
+        except Exception as e:
+            logging.error("History flush failed (%s rows): %s", len(batch), e)
+            ok = False
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        self._cond.acquire()
+        self._flushing = False
+
+        if ok:
+
+            for _ in range(count):
+                self._pending.popleft()
+                self._enqueued_at.popleft()
+
+            self._stats["flushed"] += count
+            self._overflowing = False
+            self._stats["batches"] += 1
+            self._stats["last_flush_ms"] = elapsed_ms
+            self._stats["total_flush_ms"] += elapsed_ms
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], elapsed_ms)
+            self._stats["max_queue_wait_ms"] = max(
+                self._stats["max_queue_wait_ms"],
+                (started - oldest) * 1000
+            )
+
+        else:
+            self._stats["failures"] += 1
+
+        self._cond.notify_all()
+
+        return ok
+
+
+history_writer = HistoryWriter(
+    HISTORY_FLUSH_SIZE,
+    HISTORY_FLUSH_INTERVAL,
+    HISTORY_QUEUE_MAX
+)
+
+atexit.register(history_writer.close)
+
+
+def flush_history(timeout=None):
+    history_writer.flush(timeout)
+
+
+def history_stats():
+    return history_writer.stats()
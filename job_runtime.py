@@ -0,0 +1,132 @@
+import time
+import asyncio
+import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from config import JOB_EXECUTOR_WORKERS, LOOP_LAG_INTERVAL, LOOP_LAG_WARN_MS
+
+
+# =====================================
+# SCHEDULED JOB RUNTIME
+# Blocking DB / LLM work started by job callbacks runs on one
+# bounded executor, never on the event loop and never on the
+# loop's default pool. Each job run also measures how late the
+# event loop gets while it runs (the delay incoming messages
+# would see) and logs it.
+# =====================================
+
+job_executor = ThreadPoolExecutor(
+    max_workers=JOB_EXECUTOR_WORKERS,
+    thread_name_prefix="job"
+)
+
+
+async def run_blocking(fn, *args, **kwargs):
+
+    loop = asyncio.get_running_loop()
+
+    return await loop.run_in_executor(job_executor, functools.partial(fn, *args, **kwargs))
+
+
+class LoopLagMonitor:
+
+    # A probe that asks to wake up every `interval`; how late it
+    # actually wakes up is the event loop's lag
+
+    def __init__(self, interval):
+
+        self.interval = interval
+        self.samples = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._probe())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    @property
+    def avg_ms(self):
+        return self.total_ms / self.samples if self.samples else 0.0
+
+    async def _probe(self):
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+
+            lag_ms = max(0.0, loop.time() - expected) * 1000
+
+            self.samples += 1
+            self.total_ms += lag_ms
+            self.max_ms = max(self.max_ms, lag_ms)
+
+
+_job_stats = {}
+_stats_lock = threading.Lock()
+
+
+def monitored_job(fn):
+
+    # Wraps a job callback: runtime plus event-loop lag per run
+    name = fn.__name__
+
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+
+        monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
+        monitor.start()
+
+        started = time.monotonic()
+
+        try:
+            return await fn(*args, **kwargs)
+
+        finally:
+
+            monitor.stop()
+            elapsed = time.monotonic() - started
+
+            _record(name, elapsed, monitor)
+
+            log = logging.warning if monitor.max_ms >= LOOP_LAG_WARN_MS else logging.info
+
+            log(
+                "Job %s ran %.1fs, event loop lag max %.0fms avg %.1fms",
+                name, elapsed, monitor.max_ms, monitor.avg_ms
+            )
+
+    return wrapper
+
+
+def _record(name, elapsed, monitor):
+
+    with _stats_lock:
+
+        stats = _job_stats.setdefault(name, {
+            "runs": 0,
+            "last_seconds": 0.0,
+            "last_max_lag_ms": 0.0,
+            "last_avg_lag_ms": 0.0,
+            "max_lag_ms": 0.0,
+        })
+
+        stats["runs"] += 1
+        stats["last_seconds"] = elapsed
+        stats["last_max_lag_ms"] = monitor.max_ms
+        stats["last_avg_lag_ms"] = monitor.avg_ms
+        stats["max_lag_ms"] = max(stats["max_lag_ms"], monitor.max_ms)
+
+
+def job_stats():
+
+    with _stats_lock:
+        return {name: dict(stats) for name, stats in _job_stats.items()}
@@ -0,0 +1,172 @@
+import re
+import json
+from collections import namedtuple
+
+
+# =====================================
+# KEYWORD LEXICON
+# Every phrase (crisis, emotion, advice, venting) is compiled once
+# into a single trie-shaped regex, so one pass over the message
+# finds all of them and the cost per message does not grow with
+# the number of phrases. Matching keeps the old substring
+# semantics ("sad" matches "sadness").
+# =====================================
+
+DEFAULT_LEXICON = {
+
+    "crisis": [
+        "suicide",
+        "kill myself",
+        "end my life",
+        "i want to die",
+        "cant live anymore",
+        "mar jana",
+        "jeena nahi hai"
+    ],
+
+    # phrase -> emotion; earlier entries win when several match
+    "emotion": {
+        "stress": "stressed",
+        "tension": "stressed",
+        "sad": "sad",
+        "lonely": "lonely",
+        "anxious": "anxious",
+        "angry": "angry",
+        "happy": "happy"
+    },
+
+    "advice": [
+        "what should i do",
+        "kya karu",
+        "suggest",
+        "help me decide"
+    ],
+
+    "venting": [
+        "stress",
+        "tired",
+        "frustrated",
+        "upset"
+    ]
+}
+
+LexiconMatch = namedtuple("LexiconMatch", [
+    "crisis",
+    "emotion",
+    "advice",
+    "venting",
+    "phrases",
+])
+
+NO_MATCH = LexiconMatch(False, None, False, False, frozenset())
+
+
+class Lexicon:
+
+    def __init__(self, lexicon):
+
+        self.crisis = {p.lower() for p in lexicon.get("crisis", [])}
+        self.advice = {p.lower() for p in lexicon.get("advice", [])}
+        self.venting = {p.lower() for p in lexicon.get("venting", [])}
+
+        self.emotions = {}      # phrase -> (priority, emotion)
+
+        for priority, (phrase, emotion) in enumerate(lexicon.get("emotion", {}).items()):
+            self.emotions.setdefault(phrase.lower(), (priority, emotion))
+
+        phrases = self.crisis | self.advice | self.venting | set(self.emotions)
+        phrases.discard("")
+
+        # The regex reports the longest phrase starting at each position;
+        # shorter phrases that are its prefixes occurred there too
+        self._implied = {
+            p: frozenset(p[:i] for i in range(1, len(p) + 1) if p[:i] in phrases)
+            for p in phrases
+        }
+
+        self._pattern = re.compile("(?=(" + _trie_regex(phrases) + "))") if phrases else None
+
+    def scan(self, text):
+
+        if not text or self._pattern is None:
+            return NO_MATCH
+
+        found = set()
+
+        for match in self._pattern.finditer(text.lower()):
+            found |= self._implied[match.group(1)]
+
+        if not found:
+            return NO_MATCH
+
+        emotions = [self.emotions[p] for p in found if p in self.emotions]
+
+        return LexiconMatch(
+            crisis=not found.isdisjoint(self.crisis),
+            emotion=min(emotions)[1] if emotions else None,
+            advice=not found.isdisjoint(self.advice),
+            venting=not found.isdisjoint(self.venting),
+            phrases=frozenset(found),
+        )
+
+
+def _trie_regex(phrases):
+
+    trie = {}
+
+    for phrase in phrases:
+
+        node = trie
+
+        for char in phrase:
+            node = node.setdefault(char, {})
+
+        node[""] = True
+
+    return _node_regex(trie)
+
+
+def _node_regex(node):
+
+    terminal = "" in node
+
+    branches = [
+        re.escape(char) + _node_regex(child)
+        for char, child in sorted(node.items())
+        if char != ""
+    ]
+
+    if not branches:
+        return ""
+
+    body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+
+    # Greedy optional tail: the longest phrase wins at each position
+    if terminal:
+        return "(?:" + body + ")?"
+
+    return body
+
+
+def load_lexicon(path=None):
+
+    # Extra phrases from a JSON file (same shape as DEFAULT_LEXICON)
+    # are merged on top of the built-in lexicon
+    lexicon = {
+        "crisis": list(DEFAULT_LEXICON["crisis"]),
+        "emotion": dict(DEFAULT_LEXICON["emotion"]),
+        "advice": list(DEFAULT_LEXICON["advice"]),
+        "venting": list(DEFAULT_LEXICON["venting"]),
+    }
+
+    if path:
+
+        with open(path, encoding="utf-8") as f:
+            extra = json.load(f)
+
+        for key in ("crisis", "advice", "venting"):
+            lexicon[key].extend(extra.get(key, []))
+
+        lexicon["emotion"].update(extra.get("emotion", {}))
+
+    return Lexicon(lexicon)
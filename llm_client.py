@@ -0,0 +1,615 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    OPENROUTER_KEY,
+    LLM_BASE_URL,
+    LLM_POOL_SIZE,
+    LLM_WARMUP_CONNECTIONS,
+    LLM_CONNECT_TIMEOUT,
+    LLM_READ_TIMEOUT,
+    LLM_MODELS,
+    LLM_HEDGE_DELAY,
+    LLM_DEADLINE,
+    LLM_BREAKER_FAILURES,
+    LLM_BREAKER_RESET
+)
+
+
+class LLMError(Exception):
+    pass
+
+
+# =====================================
+# LLM HTTP CLIENT
+# One keep-alive session per process, shared by every
+# caller of call_llm (replies, check-ins, summaries).
+# =====================================
+
+class LLMClient:
+
+    def __init__(self, base_url, api_key, pool_size, connect_timeout, read_timeout):
+
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.pid = os.getpid()
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=0
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        })
+
+    def chat(self, model, messages, temperature=0.75, max_tokens=220, timeout=None):
+
+        response = self.session.post(
+            f"{self.base_url}/chat/completions",
+            json={
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+            },
+            timeout=timeout or self.timeout,
+        )
+
+        if response.status_code != 200:
+            raise LLMError(f"{model}: HTTP {response.status_code}")
+
+        data = response.json()
+
+        return data["choices"][0]["message"]["content"]
+
+    def warmup(self, connections=1):
+
+        # Open keep-alive connections (TCP + TLS) before the first user turn
+        def ping():
+            try:
+                self.session.get(f"{self.base_url}/models", timeout=self.timeout).close()
+            except Exception as e:
+                logging.warning("LLM warmup failed: %s", e)
+
+        threads = [threading.Thread(target=ping) for _ in range(connections)]
+
+        for t in threads:
+            t.start()
+
+        for t in threads:
+            t.join()
+
+    def close(self):
+        self.session.close()
+
+
+# =====================================
+# ASYNC LLM HTTP CLIENT
+# httpx keep-alive pool for the asyncio engine path; one per
+# event loop, since its connections belong to that loop.
+# =====================================
+
+class AsyncLLMClient:
+
+    def __init__(self, base_url, api_key, pool_size, connect_timeout, read_timeout):
+
+        self.timeout = (connect_timeout, read_timeout)
+
+        self.client = httpx.AsyncClient(
+            base_url=base_url.rstrip("/"),
+            headers={
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+            },
+            limits=httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size
+            ),
+            timeout=_httpx_timeout(self.timeout),
+        )
+
+    async def chat(self, model, messages, temperature=0.75, max_tokens=220, timeout=None):
+
+        response = await self.client.post(
+            "/chat/completions",
+            json={
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+            },
+            timeout=_httpx_timeout(timeout or self.timeout),
+        )
+
+        if response.status_code != 200:
+            raise LLMError(f"{model}: HTTP {response.status_code}")
+
+        data = response.json()
+
+        return data["choices"][0]["message"]["content"]
+
+    async def stream(self, model, messages, temperature=0.75, max_tokens=220, timeout=None):
+
+        # Server-sent events; closing the generator early (aclose /
+        # cancellation) drops the connection, which stops generation
+        # on the provider side
+        request = self.client.stream(
+            "POST",
+            "/chat/completions",
+            json={
+                "model": model,
+                "messages": messages,
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "stream": True,
+            },
+            timeout=_httpx_timeout(timeout or self.timeout),
+        )
+
+        async with request as response:
+
+            if response.status_code != 200:
+                raise LLMError(f"{model}: HTTP {response.status_code}")
+
+            async for line in response.aiter_lines():
+
+                if not line or not line.startswith("data:"):
+                    continue
+
+                payload = line[5:].strip()
+
+                if payload == "[DONE]":
+                    return
+
+                data = json.loads(payload)
+                choices = data.get("choices") or [{}]
+                token = (choices[0].get("delta") or {}).get("content")
+
+                if token:
+                    yield token
+
+    async def warmup(self, connections=1):
+
+        async def ping():
+            try:
+                await self.client.get("/models")
+            except Exception as e:
+                logging.warning("LLM warmup failed: %s", e)
+
+        await asyncio.gather(*(ping() for _ in range(connections)))
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def _httpx_timeout(timeout):
+
+    connect, read = timeout
+
+    return httpx.Timeout(read, connect=connect)
+
+
+# =====================================
+# CIRCUIT BREAKER (per model)
+# closed -> open after N consecutive failures,
+# open -> half_open after reset_timeout (one probe request)
+# =====================================
+
+class CircuitBreaker:
+
+    def __init__(self, failure_threshold, reset_timeout):
+
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+
+        with self._lock:
+
+            if self.state == "closed":
+                return True
+
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probing = False
+
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                return True
+
+            return False
+
+    def record_success(self):
+
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._probing = False
+
+    def record_failure(self):
+
+        with self._lock:
+
+            self.failures += 1
+            self._probing = False
+
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+# =====================================
+# MODEL ROUTER
+# Tries models in order under one overall deadline. If the
+# current attempt has not answered after hedge_delay, the next
+# model is started too and the first good answer wins.
+# =====================================
+
+class ModelRouter:
+
+    def __init__(self, client, models, hedge_delay, deadline, breaker_failures, breaker_reset):
+
+        self.client = client
+        self.models = list(models)
+        self.hedge_delay = hedge_delay
+        self.deadline = deadline
+        self.pid = os.getpid()
+
+        self.breakers = {
+            m: CircuitBreaker(breaker_failures, breaker_reset)
+            for m in self.models
+        }
+
+        self._executor = ThreadPoolExecutor(
+            max_workers=max(2, LLM_POOL_SIZE),
+            thread_name_prefix="llm"
+        )
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "hedged": 0,
+            "deadline_exceeded": 0,
+            "no_model_available": 0,
+            "failed": 0,
+            "wins": {m: 0 for m in self.models},
+        }
+
+    def complete(self, messages, **kwargs):
+
+        self._count("requests")
+
+        deadline = time.monotonic() + self.deadline
+
+        # Breakers are asked lazily, only for the model being started:
+        # allow() claims the single half-open probe slot
+        candidates = list(self.models)
+
+        pending = {}
+
+        def launch():
+            while candidates:
+                model = candidates.pop(0)
+                if not self.breakers[model].allow():
+                    continue
+                future = self._executor.submit(self._attempt, model, messages, deadline, kwargs)
+                pending[future] = model
+                return True
+            return False
+
+        if not launch():
+            self._count("no_model_available")
+            return None
+
+        while pending:
+
+            remaining = deadline - time.monotonic()
+
+            if remaining <= 0:
+                self._count("deadline_exceeded")
+                return None
+
+            timeout = min(remaining, self.hedge_delay) if candidates else remaining
+
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+            if not done:
+
+                if launch():
+                    self._count("hedged")
+
+                continue
+
+            for future in done:
+
+                model = pending.pop(future)
+                result = future.result()
+
+                if result is not None:
+
+                    with self._lock:
+                        self._stats["wins"][model] += 1
+
+                    return result
+
+                launch()
+
+        self._count("failed")
+        return None
+
+    async def stream_async(self, messages, **kwargs):
+
+        # Same routing as complete(), applied to time-to-first-token:
+        # the first model to produce a token owns the rest of the
+        # stream. A losing opener is cancelled, closing its connection.
+        self._count("requests")
+
+        client = get_async_llm_client()
+        deadline = time.monotonic() + self.deadline
+
+        # Breakers are asked lazily, only for the model being started:
+        # allow() claims the single half-open probe slot
+        candidates = list(self.models)
+
+        pending = {}
+        winner = None
+
+        def launch():
+            while candidates:
+                model = candidates.pop(0)
+                if not self.breakers[model].allow():
+                    continue
+                task = asyncio.ensure_future(self._open_stream_async(client, model, messages, deadline, kwargs))
+                pending[task] = model
+                return True
+            return False
+
+        if not launch():
+            self._count("no_model_available")
+            return
+
+        try:
+
+            while pending and winner is None:
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    break
+
+                timeout = min(remaining, self.hedge_delay) if candidates else remaining
+
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+
+                    if launch():
+                        self._count("hedged")
+
+                    continue
+
+                for task in done:
+
+                    model = pending.pop(task)
+                    opened = task.result()
+
+                    if opened is None:
+                        launch()
+                        continue
+
+                    if winner is None:
+                        winner = (model, opened)
+                    else:
+                        await opened[1].aclose()
+
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if winner is None:
+            self._count("deadline_exceeded" if time.monotonic() >= deadline else "failed")
+            return
+
+        model, (first, tokens) = winner
+
+        with self._lock:
+            self._stats["wins"][model] += 1
+
+        try:
+
+            yield first
+
+            async for token in tokens:
+
+                if time.monotonic() >= deadline:
+                    self._count("deadline_exceeded")
+                    return
+
+                yield token
+
+        except Exception as e:
+            logging.warning("LLM %s stream broke: %s", model, e)
+            self.breakers[model].record_failure()
+
+        finally:
+            await tokens.aclose()
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                **self._stats,
+                "wins": dict(self._stats["wins"]),
+                "breakers": {m: b.state for m, b in self.breakers.items()},
+            }
+
+    def _attempt(self, model, messages, deadline, kwargs):
+
+        breaker = self.breakers[model]
+        remaining = deadline - time.monotonic()
+
+        if remaining <= 0:
+            return None
+
+        timeout = (
+            min(self.client.timeout[0], remaining),
+            min(self.client.timeout[1], remaining)
+        )
+
+        try:
+            result = self.client.chat(model, messages, timeout=timeout, **kwargs)
+        except Exception as e:
+            logging.warning("LLM %s failed: %s", model, e)
+            breaker.record_failure()
+            return None
+
+        breaker.record_success()
+
+        return result
+
+    async def _open_stream_async(self, client, model, messages, deadline, kwargs):
+
+        breaker = self.breakers[model]
+        remaining = deadline - time.monotonic()
+
+        if remaining <= 0:
+            return None
+
+        timeout = (
+            min(client.timeout[0], remaining),
+            min(client.timeout[1], remaining)
+        )
+
+        tokens = client.stream(model, messages, timeout=timeout, **kwargs)
+
+        try:
+            first = await asyncio.wait_for(tokens.__anext__(), remaining)
+        except StopAsyncIteration:
+            logging.warning("LLM %s stream was empty", model)
+            breaker.record_failure()
+            return None
+        except Exception as e:
+            logging.warning("LLM %s failed: %s", model, e)
+            await tokens.aclose()
+            breaker.record_failure()
+            return None
+
+        breaker.record_success()
+
+        return first, tokens
+
+    def _count(self, key):
+
+        with self._lock:
+            self._stats[key] += 1
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_llm_client():
+
+    global _client
+
+    client = _client
+
+    if client is not None and client.pid == os.getpid():
+        return client
+
+    with _client_lock:
+
+        if _client is None or _client.pid != os.getpid():
+            _client = LLMClient(
+                LLM_BASE_URL,
+                OPENROUTER_KEY,
+                LLM_POOL_SIZE,
+                LLM_CONNECT_TIMEOUT,
+                LLM_READ_TIMEOUT
+            )
+
+        return _client
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_llm_router():
+
+    global _router
+
+    router = _router
+
+    if router is not None and router.pid == os.getpid():
+        return router
+
+    with _router_lock:
+
+        if _router is None or _router.pid != os.getpid():
+            _router = ModelRouter(
+                get_llm_client(),
+                LLM_MODELS,
+                LLM_HEDGE_DELAY,
+                LLM_DEADLINE,
+                LLM_BREAKER_FAILURES,
+                LLM_BREAKER_RESET
+            )
+
+        return _router
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_llm_client():
+
+    # Only called on an event loop thread; one client per loop
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+
+    if client is None:
+        client = AsyncLLMClient(
+            LLM_BASE_URL,
+            OPENROUTER_KEY,
+            LLM_POOL_SIZE,
+            LLM_CONNECT_TIMEOUT,
+            LLM_READ_TIMEOUT
+        )
+        _async_clients[loop] = client
+
+    return client
+
+
+def llm_stats():
+    return get_llm_router().stats()
+
+
+def warmup_llm():
+    get_llm_client().warmup(LLM_WARMUP_CONNECTIONS)
+
+
+async def warmup_llm_async():
+    await get_async_llm_client().warmup(LLM_WARMUP_CONNECTIONS)
@@ -1,9 +1,20 @@
-import requests
+import os
+import re
 import random
+import asyncio
+import threading
+from collections import namedtuple
 from datetime import date
-from config import OPENROUTER_KEY
-from db import get_db
+from config import LEXICON_PATH, PROMPT_TOKEN_BUDGET
+from db import get_cursor, get_async_cursor
+from history_writer import history_writer
+from lexicon import load_lexicon
+from llm_client import get_llm_router
 from payments import create_payment_link
+from prompt_builder import PromptBuilder
+from session_cache import session_cache
+from user_state import user_state, FREE_NUDGE_AT, FREE_DAILY_LIMIT
+from task_queue import register_task, enqueue_task_async
 
 
 # =====================================
@@ -110,78 +121,59 @@ Keep tone natural and conversational.
 }
 
 # =====================================
-# CRISIS DETECTION
+# PROMPT ASSEMBLY
+# static prefixes are built once; see prompt_builder.py
 # =====================================
 
-def detect_crisis(text):
+prompt_builder = PromptBuilder(BASE_PROMPT, STYLE_GUIDE, PROMPT_TOKEN_BUDGET)
 
-    if not text:
-        return False
 
-    text = text.lower()
+def prompt_stats():
+    return prompt_builder.stats()
 
-    triggers = [
-        "suicide",
-        "kill myself",
-        "end my life",
-        "i want to die",
-        "cant live anymore",
-        "mar jana",
-        "jeena nahi hai"
-    ]
+# =====================================
+# KEYWORD MATCHING
+# crisis / emotion / advice / venting phrases are compiled
+# once (lexicon.py); a message is scanned a single time
+# =====================================
+
+LEXICON = load_lexicon(LEXICON_PATH)
 
-    return any(t in text for t in triggers)
+SUPPORT_EMOTIONS = frozenset(["sad", "lonely", "stressed", "anxious"])
 
 # =====================================
-# MESSAGE INTERPRETATION
+# CRISIS DETECTION
 # =====================================
 
-def interpret_message(user_message):
+def detect_crisis(text, matches=None):
 
-    text = user_message.lower()
+    if not text:
+        return False
 
-    emotion = None
-    intent = "conversation"
+    if matches is None:
+        matches = LEXICON.scan(text)
 
-    emotion_keywords = {
-        "stress": "stressed",
-        "tension": "stressed",
-        "sad": "sad",
-        "lonely": "lonely",
-        "anxious": "anxious",
-        "angry": "angry",
-        "happy": "happy"
-    }
+    return matches.crisis
 
-    for k, v in emotion_keywords.items():
-        if k in text:
-            emotion = v
-            break
+# =====================================
+# MESSAGE INTERPRETATION
+# =====================================
 
-    advice_triggers = [
-        "what should i do",
-        "kya karu",
-        "suggest",
-        "help me decide"
-    ]
+def interpret_message(user_message, matches=None):
 
-    for trigger in advice_triggers:
-        if trigger in text:
-            intent = "advice"
+    if matches is None:
+        matches = LEXICON.scan(user_message)
 
-    venting_words = [
-        "stress",
-        "tired",
-        "frustrated",
-        "upset"
-    ]
+    intent = "conversation"
+
+    if matches.venting:
+        intent = "venting"
 
-    for w in venting_words:
-        if w in text:
-            intent = "venting"
+    elif matches.advice:
+        intent = "advice"
 
     return {
-        "emotion": emotion,
+        "emotion": matches.emotion,
         "intent": intent
     }
 
@@ -194,7 +186,7 @@ def decide_strategy(state):
     if state["intent"] == "advice":
         return "guide"
 
-    if state["emotion"] in ["sad", "lonely", "stressed", "anxious"]:
+    if state["emotion"] in SUPPORT_EMOTIONS:
         return "support"
 
     return "friend"
@@ -207,39 +199,11 @@ def decide_strategy(state):
 
 def save_message(platform, user_id, role, message):
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        INSERT INTO conversation_history
-        (platform, platform_user_id, role, message)
-        VALUES (%s,%s,%s,%s)
-    """, (platform, user_id, role, message))
-
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
-def get_recent_messages(platform, user_id, limit=8):
-
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT role, message
-        FROM conversation_history
-        WHERE platform=%s AND platform_user_id=%s
-        ORDER BY created_at DESC
-        LIMIT %s
-    """, (platform, user_id, limit))
-
-    rows = cur.fetchall()
+    # Buffered: written in bulk off the reply path (see history_writer).
+    # Runs on an event loop, so a full buffer drops instead of waiting
+    history_writer.append(platform, user_id, role, message, block=False)
 
-    cur.close()
-    conn.close()
-
-    return list(reversed(rows))
+    session_cache.append_turn(platform, user_id, role, message)
 
 
 # =====================================
@@ -248,23 +212,19 @@ def get_recent_messages(platform, user_id, limit=8):
 
 def extract_user_memory(platform, user_id):
 
-    conn = get_db()
-    cur = conn.cursor()
-
-    cur.execute("""
-        SELECT message
-        FROM conversation_history
-        WHERE platform=%s
-        AND platform_user_id=%s
-        AND role='user'
-        ORDER BY created_at DESC
-        LIMIT 12
-    """, (platform, user_id))
+    with get_cursor() as cur:
 
-    rows = cur.fetchall()
+        cur.execute("""
+            SELECT message
+            FROM conversation_history
+            WHERE platform=%s
+            AND platform_user_id=%s
+            AND role='user'
+            ORDER BY created_at DESC
+            LIMIT 12
+        """, (platform, user_id))
 
-    cur.close()
-    conn.close()
+        rows = cur.fetchall()
 
     if not rows:
         return None
@@ -299,39 +259,244 @@ Messages:
 
 def save_user_memory(platform, user_id, summary):
 
-    conn = get_db()
-    cur = conn.cursor()
+    # The "remember this" line is written once here, off the reply
+    # path, and stored with the memory for generate_reply to reuse
+    callback = generate_memory_callback(summary)
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            INSERT INTO user_memory (platform, platform_user_id, summary, callback)
+            VALUES (%s,%s,%s,%s)
+            RETURNING id
+        """, (platform, user_id, summary, callback))
+
+        memory_id = cur.fetchone()[0]
+
+    session_cache.add_memory(platform, user_id, (memory_id, summary, callback))
+
+
+def generate_memory_callback(memory):
+
+    memory_prompt = f"""
+    The user previously mentioned this fact:
+    
+    {memory}
+    
+    Write ONE casual message remembering this.
+
+    Rules:
+    - Hinglish
+    - 1 short sentence
+    - sound like a friend remembering something
+    - do not sound like a therapist
+    """
+
+    callback_reply = call_llm([
+        {"role": "user", "content": memory_prompt}
+    ])
+
+    if not callback_reply:
+        return None
+
+    return callback_reply.strip()
+
+
+# =====================================
+# TURN CONTEXT (single round trip)
+# =====================================
+
+UserContext = namedtuple("UserContext", [
+    "is_new",
+    "message_count",    # today's count before this turn
+    "previous_count",   # message_count of the last turn seen before this one
+    "is_premium",
+    "memories",         # [(id, summary, callback)]
+    "history",          # [(role, message)]
+    "onboarding",       # existing user who has not seen the intro yet
+])
+
+
+# Reserves today's quota slot with one atomic upsert (daily rollover folded
+# in) and loads the prompt context in the same statement. Users whose
+# session is hot in this process skip the context part entirely, and
+# turns far from the free-tier thresholds skip the upsert (user_state).
+
+USER_UPSERT_SQL = """
+    INSERT INTO users
+    (platform, platform_user_id, name, last_reset, message_count, last_active)
+    VALUES (%(platform)s, %(user_id)s, %(name)s, %(today)s, 1, NOW())
+    ON CONFLICT (platform, platform_user_id) DO UPDATE
+    SET message_count = CASE
+            WHEN users.last_reset IS DISTINCT FROM EXCLUDED.last_reset THEN 0
+            ELSE users.message_count
+        END
+        + %(increment)s
+        - (NOT COALESCE(users.onboarding_completed, FALSE))::int,  -- the intro turn is free
+        last_reset = EXCLUDED.last_reset,
+        last_active = NOW(),
+        onboarding_completed = TRUE
+    RETURNING (xmax = 0) AS inserted, message_count, is_premium, premium_expires_at
+"""
+
+# prev sees the row as it was before the upsert (same snapshot)
+USER_TURN_CTE = f"""
+    WITH prev AS (
+        SELECT onboarding_completed
+        FROM users
+        WHERE platform=%(platform)s
+        AND platform_user_id=%(user_id)s
+    ),
+    u AS ({USER_UPSERT_SQL})
+"""
+
+USER_TURN_COLUMNS = """
+    u.inserted,
+    u.message_count,
+    u.is_premium,
+    u.premium_expires_at,
+    NOT u.inserted AND NOT COALESCE(prev.onboarding_completed, FALSE)
+"""
+
+USER_TURN_SQL = f"""
+    {USER_TURN_CTE}
+    SELECT {USER_TURN_COLUMNS}
+    FROM u LEFT JOIN prev ON TRUE
+"""
+
+CONTEXT_COLUMNS_SQL = """
+    COALESCE((
+        SELECT json_agg(json_build_array(m.id, m.summary, m.callback) ORDER BY m.created_at DESC)
+        FROM (
+            SELECT id, summary, callback, created_at
+            FROM user_memory
+            WHERE platform=%(platform)s
+            AND platform_user_id=%(user_id)s
+            ORDER BY created_at DESC
+            LIMIT %(memory_limit)s
+        ) m
+    ), '[]'),
+    COALESCE((
+        SELECT json_agg(json_build_array(h.role, h.message) ORDER BY h.created_at)
+        FROM (
+            SELECT role, message, created_at
+            FROM conversation_history
+            WHERE platform=%(platform)s
+            AND platform_user_id=%(user_id)s
+            ORDER BY created_at DESC
+            LIMIT %(history_limit)s
+        ) h
+    ), '[]')
+"""
+
+USER_CONTEXT_SQL = f"""
+    {USER_TURN_CTE}
+    SELECT {USER_TURN_COLUMNS}, {CONTEXT_COLUMNS_SQL}
+    FROM u LEFT JOIN prev ON TRUE
+"""
+
+CONTEXT_ONLY_SQL = f"SELECT {CONTEXT_COLUMNS_SQL}"
+
+
+async def load_user_context_async(platform, user_id, name, history_limit=8, memory_limit=6):
+
+    today = date.today()
+
+    params = {
+        "platform": platform,
+        "user_id": user_id,
+        "name": name,
+        "today": today,
+        "increment": 1,
+        "history_limit": history_limit,
+        "memory_limit": memory_limit,
+    }
+
+    # Far from the free-tier thresholds the quota is counted locally
+    # (see user_state); with a hot session this turn needs no DB at all.
+    # The local count is only trusted on single-process platforms, which
+    # is also what makes it a valid key for the session cache check
+    reserved = user_state.reserve(platform, user_id, today)
+
+    if reserved is not None:
+
+        message_count, is_premium = reserved
+        inserted = onboarding = False
+        previous_count = message_count - 1
+
+        cached = session_cache.lookup(platform, user_id, message_count, today)
+
+        if cached is None:
+
+            async with get_async_cursor() as cur:
+                await cur.execute(CONTEXT_ONLY_SQL, params)
+                memories, history = await cur.fetchone()
+
+    else:
+
+        params["increment"] += user_state.take_pending(platform, user_id, today)
+
+        cached = None
 
-    cur.execute("""
-        INSERT INTO user_memory (platform, platform_user_id, summary)
-        VALUES (%s,%s,%s)
-    """, (platform, user_id, summary))
+        try:
+
+            async with get_async_cursor() as cur:
+
+                if session_cache.is_warm(platform, user_id):
+
+                    await cur.execute(USER_TURN_SQL, params)
+
+                    inserted, message_count, is_premium, premium_until, onboarding = await cur.fetchone()
+
+                    if not inserted:
+                        cached = session_cache.lookup(platform, user_id, message_count, today)
+
+                    if cached is None:
+                        await cur.execute(CONTEXT_ONLY_SQL, params)
+                        memories, history = await cur.fetchone()
+
+                else:
+
+                    await cur.execute(USER_CONTEXT_SQL, params)
 
-    conn.commit()
-    cur.close()
-    conn.close()
+                    (
+                        inserted, message_count, is_premium, premium_until, onboarding,
+                        memories, history
+                    ) = await cur.fetchone()
 
+        except Exception:
+            user_state.give_back(platform, user_id, today, params["increment"] - 1)
+            raise
 
-def get_user_memories(platform, user_id):
+        # Turns counted locally since the last sync land in this upsert
+        # too, so the count may have jumped by more than one
+        previous_count = message_count - params["increment"]
 
-    conn = get_db()
-    cur = conn.cursor()
+        # a brand-new user's next turn must reach the DB for the onboarding flag
+        if not inserted:
+            user_state.sync(platform, user_id, message_count, today, bool(is_premium), premium_until)
 
-    cur.execute("""
-        SELECT summary
-        FROM user_memory
-        WHERE platform=%s
-        AND platform_user_id=%s
-        ORDER BY created_at DESC
-        LIMIT 6
-    """, (platform, user_id))
+    if cached is not None:
+        history, memories = cached
 
-    rows = cur.fetchall()
+    else:
+        memories = [tuple(m) for m in memories]
+        history = [tuple(h) for h in history]
 
-    cur.close()
-    conn.close()
+        session_cache.put(
+            platform, user_id, message_count, today,
+            history, memories, history_limit, memory_limit
+        )
 
-    return [r[0] for r in rows]
+    return UserContext(
+        is_new=inserted,
+        message_count=message_count - 1,
+        previous_count=previous_count - 1,
+        is_premium=bool(is_premium),
+        memories=memories,
+        history=history,
+        onboarding=onboarding,
+    )
 
 
 # =====================================
@@ -340,22 +505,18 @@ def get_user_memories(platform, user_id):
 
 def generate_conversation_summary(platform, user_id):
 
-    conn = get_db()
-    cur = conn.cursor()
+    with get_cursor() as cur:
 
-    cur.execute("""
-        SELECT message
-        FROM conversation_history
-        WHERE platform=%s
-        AND platform_user_id=%s
-        ORDER BY created_at DESC
-        LIMIT 20
-    """, (platform, user_id))
-
-    rows = cur.fetchall()
+        cur.execute("""
+            SELECT message
+            FROM conversation_history
+            WHERE platform=%s
+            AND platform_user_id=%s
+            ORDER BY created_at DESC
+            LIMIT 20
+        """, (platform, user_id))
 
-    cur.close()
-    conn.close()
+        rows = cur.fetchall()
 
     if not rows:
         return None
@@ -385,55 +546,106 @@ Conversation:
 
 
 # =====================================
-# LLM CALL
+# BACKGROUND MEMORY TASKS
 # =====================================
 
-def call_llm(messages):
+@register_task("extract_memory")
+def extract_memory_task(payload):
 
-    models = [
-        "arcee-ai/trinity-large-preview:free", 
-        "meta-llama/llama-3.2-3b-instruct:free"
-    ]
+    memory = extract_user_memory(payload["platform"], payload["user_id"])
 
-    for model in models:
+    if memory:
+        save_user_memory(payload["platform"], payload["user_id"], memory)
 
-        try:
 
-            response = requests.post(
-                "https://openrouter.ai/api/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {OPENROUTER_KEY}",
-                    "Content-Type": "application/json",
-                },
-                json={
-                    "model": model,
-                    "messages": messages,
-                    "temperature": 0.75,
-                    "max_tokens": 220,
-                },
-                timeout=30,
+@register_task("memory_callback")
+def memory_callback_task(payload):
+
+    callback = generate_memory_callback(payload["summary"])
+
+    if callback:
+
+        with get_cursor() as cur:
+
+            cur.execute("""
+                UPDATE user_memory
+                SET callback = %s
+                WHERE id = %s
+            """, (callback, payload["memory_id"]))
+
+        if "platform" in payload:
+            session_cache.set_callback(
+                payload["platform"], payload["user_id"], payload["memory_id"], callback
             )
 
-            if response.status_code != 200:
-                continue
 
-            data = response.json()
+@register_task("summarize")
+def summarize_task(payload):
 
-            return data["choices"][0]["message"]["content"]
+    summary = generate_conversation_summary(payload["platform"], payload["user_id"])
 
-        except Exception:
-            continue
+    if summary:
+        save_user_memory(payload["platform"], payload["user_id"], summary)
+
+
+# =====================================
+# LLM CALL
+# =====================================
+
+def call_llm(messages, **kwargs):
+
+    # Model order, hedging, circuit breakers and the overall
+    # deadline are handled by the router (see llm_client)
+    return get_llm_router().complete(messages, **kwargs)
+
+
+SENTENCE_END = re.compile(r"[.!?]\s")
+
+
+async def stream_reply_line_async(messages, limit=220, on_partial=None):
 
-    return None
+    # Only the first non-empty line (max `limit` chars) is ever sent, so
+    # stop the stream there instead of paying for the rest of it.
+    # on_partial is a plain callback, run on the event loop.
+    text = ""
+    partial_sent = False
+
+    tokens = get_llm_router().stream_async(messages)
+
+    try:
+
+        async for token in tokens:
+
+            text = (text + token).lstrip()
+
+            if "\n" in text:
+                text = text.split("\n", 1)[0]
+                break
+
+            if len(text) >= limit:
+                break
+
+            if on_partial and not partial_sent:
+
+                match = SENTENCE_END.search(text)
+
+                if match:
+                    on_partial(text[:match.start() + 1])
+                    partial_sent = True
+
+    finally:
+        await tokens.aclose()
+
+    return text or None
 
 
 # =====================================
-# DAILY CHECKIN GENERATOR
+# CHECK-IN PROMPTS
 # =====================================
 
-def daily_checkin_message():
+CHECKIN_PROMPTS = {
 
-    prompt = """
+    "daily": """
 Write a short friendly daily emotional check-in message.
 
 Rules:
@@ -441,183 +653,203 @@ Rules:
 - casual human tone
 - feels like a friend texting
 - not motivational speech
-"""
+""",
+
+    "late_night": """
+Write a short late-night emotional check-in message.
+
+Rules:
+- calm tone
+- 1 or 2 sentences
+- feels like a friend texting late at night
+""",
+
+    "proactive": """
+Write a short emotional check-in message.
+
+Rules:
+- 1 or 2 sentences
+- Hinglish
+- casual WhatsApp tone
+- like a friend randomly checking in
+- not motivational
+
+Example style:
+"hey… aaj thoda better feel ho raha hai?"
+""",
+}
+
+CHECKIN_FALLBACKS = {
+    "daily": "Hey… just checking in. How’s your day going?",
+    "late_night": "Still awake? Nights can feel quiet sometimes.",
+    "proactive": "hey… bas randomly pooch raha tha, sab theek?",
+}
+
+
+def checkin_message(category):
 
     reply = call_llm([
-        {"role": "user", "content": prompt}
+        {"role": "user", "content": CHECKIN_PROMPTS[category]}
     ])
 
     if not reply:
-        reply = "Hey… just checking in. How’s your day going?"
+        reply = CHECKIN_FALLBACKS[category]
 
     return reply
 
 
 # =====================================
-# LATE NIGHT CHECKIN GENERATOR
+# CHECK-IN BATCH GENERATOR
+# one LLM call -> many variants (see checkin_pool)
 # =====================================
 
-def late_night_checkin_message():
+LIST_MARKER = re.compile(r"^\s*(?:\d+[.)]|[-•*])\s*")
 
-    prompt = """
-Write a short late-night emotional check-in message.
 
-Rules:
-- calm tone
-- 1 or 2 sentences
-- feels like a friend texting late at night
+def generate_checkin_batch(category, count):
+
+    prompt = CHECKIN_PROMPTS[category] + f"""
+Write {count} different versions of this message.
+Vary the wording and the opening of each one.
+Reply with one message per line and nothing else.
 """
 
-    reply = call_llm([
-        {"role": "user", "content": prompt}
-    ])
+    reply = call_llm(
+        [{"role": "user", "content": prompt}],
+        max_tokens=60 * count
+    )
 
     if not reply:
-        reply = "Still awake? Nights can feel quiet sometimes."
+        return []
 
-    return reply
+    variants = []
+
+    for line in reply.split("\n"):
+
+        line = LIST_MARKER.sub("", line).strip().strip('"“”').strip()
+
+        if 3 <= len(line) <= 220 and line not in variants:
+            variants.append(line)
+
+    return variants[:count]
 
 
 # =====================================
-# Proactive Check-In System GENERATOR
+# DAILY CHECKIN GENERATOR
 # =====================================
 
-def proactive_emotional_checkin():
+def daily_checkin_message():
+    return checkin_message("daily")
 
-    prompt = """
-Write a short emotional check-in message.
 
-Rules:
-- 1 or 2 sentences
-- Hinglish
-- casual WhatsApp tone
-- like a friend randomly checking in
-- not motivational
+# =====================================
+# LATE NIGHT CHECKIN GENERATOR
+# =====================================
 
-Example style:
-"hey… aaj thoda better feel ho raha hai?"
-"""
+def late_night_checkin_message():
+    return checkin_message("late_night")
 
-    reply = call_llm([
-        {"role": "user", "content": prompt}
-    ])
 
-    if not reply:
-        reply = "hey… bas randomly pooch raha tha, sab theek?"
+# =====================================
+# Proactive Check-In System GENERATOR
+# =====================================
 
-    return reply
+def proactive_emotional_checkin():
+    return checkin_message("proactive")
 
 
 # =====================================
 # MAIN REPLY ENGINE
 # =====================================
 
-def generate_reply(platform, user_id, name, user_message):
+TurnResult = namedtuple("TurnResult", [
+    "text",
+    "onboarding",   # text is the intro message; send it right away
+])
+
+ONBOARDING_MESSAGE = (
+    "Hey 🙂 I'm Maya.\n\n"
+    "You can talk to me about anything — what's going on today?"
+)
+
+async def handle_turn_async(platform, user_id, name, user_message, on_partial=None):
 
     msg_lower = user_message.lower().strip()
 
-    if detect_crisis(user_message):
+    # one pass over the message for every keyword list
+    matches = LEXICON.scan(user_message)
 
-        return (
+    if detect_crisis(user_message, matches):
+
+        return TurnResult((
             "I'm really sorry you're feeling this way.\n\n"
             "You deserve support and you don’t have to go through this alone.\n\n"
             "📞 Kiran Mental Health Helpline: 1800-599-0019"
-        )
+        ), False)
 
 
     
 
     if msg_lower == "trial":
 
-        link = create_payment_link(platform, user_id, "trial")
+        link = await asyncio.to_thread(create_payment_link, platform, user_id, "trial")
 
-        return (
+        return TurnResult((
             "🎁 3-Day Trial – ₹19\n\n"
             "Unlimited access for 3 days 💛\n\n"
             f"Payment link:\n{link}"
-        )
+        ), False)
 
 
     if msg_lower == "monthly":
 
-        link = create_payment_link(platform, user_id, "monthly")
+        link = await asyncio.to_thread(create_payment_link, platform, user_id, "monthly")
 
-        return (
+        return TurnResult((
             "💎 Maya Premium – ₹149/month\n\n"
             "Unlimited access + full emotional analytics 💛\n\n"
             f"Payment link:\n{link}"
-        )
+        ), False)
 
 
-    conn = get_db()
-    cur = conn.cursor()
+    ctx = await load_user_context_async(platform, user_id, name)
 
-    cur.execute("""
-        SELECT message_count, last_reset, is_premium
-        FROM users
-        WHERE platform=%s AND platform_user_id=%s
-    """, (platform, user_id))
-
-    
-
-    row = cur.fetchone()
-
-    if not row:
-
-        cur.execute("""
-            INSERT INTO users (platform, platform_user_id, name, last_reset)
-            VALUES (%s,%s,%s,%s)
-        """, (platform, user_id, name, date.today()))
-
-        conn.commit()
+    # first turn after the account row was created: introduce Maya
+    # (the flag comes from the same upsert, no extra user lookup)
+    if ctx.onboarding:
+        return TurnResult(ONBOARDING_MESSAGE, True)
 
-        message_count = 0
-        is_premium = False
+    message_count = ctx.message_count
+    is_premium = ctx.is_premium
 
-    else:
-
-        message_count, last_reset, is_premium = row
-
-        if last_reset != date.today():
-
-            cur.execute("""
-                UPDATE users
-                SET message_count=0, last_reset=%s
-                WHERE platform=%s AND platform_user_id=%s
-            """, (date.today(), platform, user_id))
-
-            conn.commit()
-
-            message_count = 0
-            
+    if not ctx.is_new:
 
         greetings = ["hi", "hello", "hey", "hii"]
     
         first_word = msg_lower.split()[0] if msg_lower.split() else ""
         if first_word in greetings and message_count == 0:
     
-            return random.choice([
+            return TurnResult(random.choice([
                 "Hey 🙂 kaisa chal raha hai aaj?",
                 "Hi! Aaj ka din kaisa ja raha hai?",
                 "Hello 🙂 mood kaisa hai?"
-            ])
+            ]), False)
 
 
-    if not is_premium and message_count == 20:
+    # crossing, not equality: the count can jump past FREE_NUDGE_AT
+    # when locally counted turns are folded into one upsert
+    if not is_premium and ctx.previous_count < FREE_NUDGE_AT <= message_count < FREE_DAILY_LIMIT:
 
-        return (
+        return TurnResult((
             "Waise ek baat bolu? 💛\n"
             "Aaj ke 10 messages baaki hain.\n"
             "Kabhi unlimited chaho to 'trial' likh sakte ho."
-        )
-
+        ), False)
 
-    if not is_premium and message_count >= 30:
 
-        cur.close()
-        conn.close()
+    if not is_premium and message_count >= FREE_DAILY_LIMIT:
 
-        return (
+        return TurnResult((
             "Lekin free version mein daily limit hota hai.\n\n"
 
             "🎁 3-Day Trial – ₹19\n"
@@ -635,76 +867,52 @@ def generate_reply(platform, user_id, name, user_message):
 
             "Agar try karna chaho to 'trial' likh do.\n"
             "Ya direct monthly ke liye 'monthly' likh do 💛"
-        )
+        ), False)
 
 
     # =====================================
     # PERSONALITY CONTEXT
     # =====================================
     
-    brain_state = interpret_message(user_message)
+    brain_state = interpret_message(user_message, matches)
     
     strategy = decide_strategy(brain_state)
     
-    style_instruction = STYLE_GUIDE.get(strategy, "")
-    
     
     # =====================================
     # MEMORY CONTEXT
     # =====================================
     
-    memories = get_user_memories(platform, user_id)
-    recent_messages = get_recent_messages(platform, user_id)
-
-    memory_block = ""
-
-    if memories:
-        memory_block = "\nKnown facts about the user:\n" + "\n".join(memories)
+    memories = ctx.memories
+    recent_messages = ctx.history
 
     # =====================================
     # MEMORY CALLBACK (bring up past things)
+    # precomputed per memory, no extra LLM call here
     # =====================================
     
     memory_callback = ""
     
     if memories and len(recent_messages) > 4 and random.random() < 0.25:  # ~25% chance
     
-        memory = random.choice(memories)
-    
-        memory_prompt = f"""
-    The user previously mentioned this fact:
-    
-    {memory}
-    
-    Write ONE casual message remembering this.
-
-    Rules:
-    - Hinglish
-    - 1 short sentence
-    - sound like a friend remembering something
-    - do not sound like a therapist
-    """
-    
-        callback_reply = call_llm([
-            {"role": "user", "content": memory_prompt}
-        ])
-    
-        if callback_reply:
-            memory_callback = callback_reply.strip()
-    
-    system_prompt = BASE_PROMPT + f"""
-    Conversation mode:
-    {strategy}
+        memory_id, memory, callback = random.choice(memories)
     
-    Guideline:
-    {style_instruction}
-    
-    {memory_block}
+        if callback:
+            memory_callback = callback
+
+        else:
+            # memories saved before callbacks existed get one backfilled
+            await enqueue_task_async(
+                "memory_callback",
+                {
+                    "memory_id": memory_id,
+                    "summary": memory,
+                    "platform": platform,
+                    "user_id": user_id
+                },
+                f"memory:{memory_id}"
+            )
     
-    Possible topic to casually bring up:
-    {memory_callback}
-    """
-
     reply_styles = [
         "Respond normally.",
         "Keep the reply very short.",
@@ -714,22 +922,22 @@ def generate_reply(platform, user_id, name, user_message):
     ]
     
     style_modifier = random.choice(reply_styles)
-    
-    system_prompt = system_prompt + f"""
-    
-    Reply style instruction:
-    {style_modifier}
-    """
-
-    messages = [{"role": "system", "content": system_prompt}]
 
-    for role, text in recent_messages:
-        messages.append({"role": role, "content": text})
+    # system prompt + history under PROMPT_TOKEN_BUDGET
+    # (oldest history, then oldest memories trimmed first)
+    prompt = prompt_builder.build(
+        strategy,
+        [m[1] for m in memories],
+        memory_callback,
+        style_modifier,
+        recent_messages,
+        user_message
+    )
 
-    messages.append({"role": "user", "content": user_message})
+    messages = prompt.messages
 
 
-    reply = call_llm(messages)
+    reply = await stream_reply_line_async(messages, on_partial=on_partial)
 
     if not reply:
         reply = "hmm… ek sec, phir se bolo?"
@@ -761,27 +969,20 @@ def generate_reply(platform, user_id, name, user_message):
 
 
     # =====================================
-    # LIFE MEMORY EXTRACTION
+    # LIFE MEMORY EXTRACTION / COMPRESSION
+    # run by background workers (task_queue); the delay lets the
+    # history buffer flush this turn before they read it
     # =====================================
 
-    if random.random() < 0.08:
-
-        memory = extract_user_memory(platform, user_id)
-
-        if memory:
-            save_user_memory(platform, user_id, memory)
+    task_payload = {"platform": platform, "user_id": user_id}
 
+    if random.random() < 0.08:
 
-    # =====================================
-    # CONVERSATION COMPRESSION
-    # =====================================
+        await enqueue_task_async("extract_memory", task_payload, f"{platform}:{user_id}", delay=5)
 
     if (message_count + 1) % 30 == 0:
 
-        summary = generate_conversation_summary(platform, user_id)
-
-        if summary:
-            save_user_memory(platform, user_id, summary)
+        await enqueue_task_async("summarize", task_payload, f"{platform}:{user_id}", delay=5)
 
     # =====================================
     # OCCASIONAL USER APPRECIATION
@@ -798,17 +999,48 @@ def generate_reply(platform, user_id, name, user_message):
     
         reply = random.choice(appreciation_messages)
 
+    return TurnResult(reply, False)
 
-    cur.execute("""
-        UPDATE users
-        SET message_count = message_count + 1,
-        last_active = NOW()
-        WHERE platform=%s AND platform_user_id=%s
-    """, (platform, user_id))
 
-    conn.commit()
+# =====================================
+# SYNC ENTRY POINTS
+# Thin wrappers for threaded callers (WhatsApp workers): the turn
+# runs on one shared engine event loop, so a waiting LLM call
+# holds no engine thread of its own.
+# =====================================
 
-    cur.close()
-    conn.close()
+_engine_loop = None
+_engine_pid = None
+_engine_lock = threading.Lock()
 
-    return reply
+
+def engine_loop():
+
+    global _engine_loop, _engine_pid
+
+    with _engine_lock:
+
+        if _engine_loop is None or _engine_pid != os.getpid():
+
+            _engine_loop = asyncio.new_event_loop()
+            _engine_pid = os.getpid()
+
+            threading.Thread(
+                target=_engine_loop.run_forever,
+                name="engine-loop",
+                daemon=True
+            ).start()
+
+        return _engine_loop
+
+
+def run_in_engine(coro):
+    return asyncio.run_coroutine_threadsafe(coro, engine_loop()).result()
+
+
+def handle_turn(platform, user_id, name, user_message, on_partial=None):
+    return run_in_engine(handle_turn_async(platform, user_id, name, user_message, on_partial))
+
+
+def generate_reply(platform, user_id, name, user_message, on_partial=None):
+    return handle_turn(platform, user_id, name, user_message, on_partial).text
@@ -0,0 +1,149 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+
+from db import get_cursor
+
+
+# =====================================
+# INBOUND IDEMPOTENCY
+# A message id is processed once: a bounded in-memory LRU answers
+# most redeliveries, processed_messages catches the rest (other
+# workers, restarts). Rows older than the TTL are cleaned up, and
+# the duplicate rate is logged on the same schedule.
+# =====================================
+
+class MessageDeduplicator:
+
+    def __init__(self, platform, lru_size, ttl_hours, cleanup_interval):
+
+        self.platform = platform
+        self.lru_size = lru_size
+        self.ttl = timedelta(hours=ttl_hours)
+        self.cleanup_interval = cleanup_interval
+
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_cleanup = time.monotonic()
+
+        self._stats = {"deliveries": 0, "duplicates": 0, "lru_hits": 0, "db_errors": 0}
+
+    def first_delivery(self, message_id):
+
+        with self._lock:
+
+            self._stats["deliveries"] += 1
+
+            if message_id in self._seen:
+                self._seen.move_to_end(message_id)
+                self._stats["duplicates"] += 1
+                self._stats["lru_hits"] += 1
+                return False
+
+        try:
+
+            with get_cursor() as cur:
+
+                cur.execute("""
+                    INSERT INTO processed_messages (platform, message_id)
+                    VALUES (%s,%s)
+                    ON CONFLICT DO NOTHING
+                """, (self.platform, message_id))
+
+                first = cur.rowcount == 1
+
+        except Exception as e:
+            # Fail open: a rare double reply beats a dropped message
+            logging.error("Dedup check failed for %s: %s", message_id, e)
+            self._count("db_errors")
+            first = True
+
+        with self._lock:
+
+            self._seen[message_id] = True
+            self._seen.move_to_end(message_id)
+
+            while len(self._seen) > self.lru_size:
+                self._seen.popitem(last=False)
+
+            if not first:
+                self._stats["duplicates"] += 1
+
+        self._maybe_cleanup()
+
+        return first
+
+    def forget(self, message_id):
+
+        # Used when a message was accepted but could not be queued,
+        # so Meta's redelivery is processed instead of dropped
+        with self._lock:
+            self._seen.pop(message_id, None)
+
+        try:
+
+            with get_cursor() as cur:
+
+                cur.execute("""
+                    DELETE FROM processed_messages
+                    WHERE platform=%s AND message_id=%s
+                """, (self.platform, message_id))
+
+        except Exception as e:
+            logging.error("Could not forget message %s: %s", message_id, e)
+
+    def stats(self):
+
+        with self._lock:
+
+            deliveries = self._stats["deliveries"]
+
+            return {
+                **self._stats,
+                "duplicate_rate": self._stats["duplicates"] / deliveries if deliveries else 0.0,
+                "lru_size": len(self._seen),
+            }
+
+    def _maybe_cleanup(self):
+
+        with self._lock:
+
+            if time.monotonic() - self._last_cleanup < self.cleanup_interval:
+                return
+
+            self._last_cleanup = time.monotonic()
+
+        stats = self.stats()
+
+        logging.info(
+            "Inbound dedup (%s): deliveries=%s duplicates=%s (%.1f%%) lru_hits=%s db_errors=%s",
+            self.platform,
+            stats["deliveries"],
+            stats["duplicates"],
+            stats["duplicate_rate"] * 100,
+            stats["lru_hits"],
+            stats["db_errors"]
+        )
+
+        threading.Thread(target=self._cleanup, daemon=True).start()
+
+    def _cleanup(self):
+
+        try:
+
+            with get_cursor() as cur:
+
+                cur.execute("""
+                    DELETE FROM processed_messages
+                    WHERE platform=%s AND seen_at < NOW() - %s
+                """, (self.platform, self.ttl))
+
+        except Exception as e:
+            logging.error("Dedup cleanup failed: %s", e)
+
+    def _count(self, key):
+
+        with self._lock:
+            self._stats[key] += 1
@@ -0,0 +1,175 @@
+import math
+import logging
+import threading
+from collections import namedtuple
+
+
+# =====================================
+# TOKEN-BUDGETED PROMPT BUILDER
+# Assembles the chat messages for a turn under a token budget.
+# The static BASE_PROMPT + strategy prefix is built once per
+# strategy; when the turn is over budget the oldest history goes
+# first, then the oldest memories, then the callback, and only
+# then is the user's own message clipped.
+# =====================================
+
+BuiltPrompt = namedtuple("BuiltPrompt", [
+    "messages",
+    "tokens",
+    "history_dropped",
+    "memories_dropped",
+    "clipped",          # user message was cut to fit
+])
+
+MESSAGE_OVERHEAD = 4    # role / separators per chat message
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+
+    # Local estimate, no tokenizer call: ~4 chars per token for
+    # English/Hinglish, never below one token per word
+    if not text:
+        return 0
+
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), len(text.split()))
+
+
+class PromptBuilder:
+
+    def __init__(self, base_prompt, style_guide, budget):
+
+        self.budget = budget
+
+        # strategy -> (prefix, tokens); built once
+        self._prefixes = {}
+
+        for strategy, instruction in style_guide.items():
+            self._prefixes[strategy] = self._prefix(base_prompt, strategy, instruction)
+
+        self._default = self._prefix(base_prompt, "friend", "")
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "requests": 0,
+            "trimmed": 0,
+            "total_tokens": 0,
+            "max_tokens": 0,
+        }
+
+    def build(self, strategy, memories, callback, style, history, user_message):
+
+        # memories: newest first; history: [(role, text)] oldest first
+        prefix, prefix_tokens = self._prefixes.get(strategy, self._default)
+
+        memories = list(memories)
+        history = list(history)
+        memories_dropped = history_dropped = 0
+        clipped = False
+
+        tail = self._tail(callback, style)
+        tail_tokens = estimate_tokens(tail)
+        user_tokens = estimate_tokens(user_message)
+
+        history_tokens = [estimate_tokens(text) + MESSAGE_OVERHEAD for _, text in history]
+        memory_tokens = [estimate_tokens(m) + 1 for m in memories]
+
+        total = (
+            prefix_tokens + tail_tokens + user_tokens + 2 * MESSAGE_OVERHEAD
+            + sum(history_tokens) + sum(memory_tokens)
+        )
+
+        while total > self.budget and history:
+            history.pop(0)
+            total -= history_tokens.pop(0)
+            history_dropped += 1
+
+        while total > self.budget and memories:
+            memories.pop()
+            total -= memory_tokens.pop()
+            memories_dropped += 1
+
+        if total > self.budget and callback:
+            tail = self._tail("", style)
+            total -= tail_tokens - estimate_tokens(tail)
+
+        if total > self.budget:
+            room = max(self.budget - (total - user_tokens), 1)
+            user_message = user_message[:room * CHARS_PER_TOKEN]
+            total += estimate_tokens(user_message) - user_tokens
+            clipped = True
+
+        memory_block = ""
+
+        if memories:
+            memory_block = "\nKnown facts about the user:\n" + "\n".join(memories)
+
+        messages = [{"role": "system", "content": prefix + memory_block + tail}]
+
+        for role, text in history:
+            messages.append({"role": role, "content": text})
+
+        messages.append({"role": "user", "content": user_message})
+
+        trimmed = bool(history_dropped or memories_dropped or clipped)
+
+        self._record(total, trimmed)
+
+        if trimmed:
+            logging.info(
+                "Prompt trimmed to ~%s tokens (history -%s, memories -%s, clipped=%s)",
+                total, history_dropped, memories_dropped, clipped
+            )
+        else:
+            logging.debug("Prompt size ~%s tokens", total)
+
+        return BuiltPrompt(messages, total, history_dropped, memories_dropped, clipped)
+
+    def stats(self):
+
+        with self._lock:
+
+            requests = self._stats["requests"]
+
+            return {
+                **self._stats,
+                "budget": self.budget,
+                "avg_tokens": self._stats["total_tokens"] / requests if requests else 0.0,
+            }
+
+    def _record(self, tokens, trimmed):
+
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["trimmed"] += int(trimmed)
+            self._stats["total_tokens"] += tokens
+            self._stats["max_tokens"] = max(self._stats["max_tokens"], tokens)
+
+    @staticmethod
+    def _prefix(base_prompt, strategy, instruction):
+
+        prefix = base_prompt + f"""
+Conversation mode:
+{strategy}
+
+Guideline:
+{instruction}
+"""
+
+        return prefix, estimate_tokens(prefix)
+
+    @staticmethod
+    def _tail(callback, style):
+
+        tail = ""
+
+        if callback:
+            tail += f"""
+Possible topic to casually bring up:
+{callback}
+"""
+
+        return tail + f"""
+Reply style instruction:
+{style}
+"""
@@ -0,0 +1,59 @@
+import time
+import asyncio
+import threading
+
+
+# =====================================
+# TOKEN BUCKET
+# Reservation style: every caller takes a token immediately (the
+# balance may go negative) and sleeps until its token is due, so
+# waiters are served in arrival order without polling. Usable
+# from threads (acquire) and from asyncio (acquire_async).
+# =====================================
+
+class TokenBucket:
+
+    def __init__(self, rate, capacity=None):
+
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, tokens=1):
+
+        with self._lock:
+
+            now = time.monotonic()
+
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= tokens
+
+            if self._tokens >= 0:
+                return 0.0
+
+            return -self._tokens / self.rate
+
+    def acquire(self, tokens=1):
+
+        wait = self.reserve(tokens)
+
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens=1):
+
+        wait = self.reserve(tokens)
+
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def penalize(self, seconds):
+
+        # Server said slow down (429 / RetryAfter): stop everyone
+        with self._lock:
+            self._tokens = min(self._tokens, -seconds * self.rate)
+            self._updated = time.monotonic()
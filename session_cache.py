@@ -0,0 +1,242 @@
+import time
+import threading
+from collections import OrderedDict, deque
+
+from config import SESSION_CACHE_BYTES, SESSION_CACHE_TTL
+
+
+# =====================================
+# HOT SESSION CACHE
+# Per-process copy of each active user's recent turns (ring
+# buffer) and memories, keyed by (platform, platform_user_id).
+# Written through by save_message / save_user_memory, evicted
+# LRU by a byte budget and by TTL. The turn upsert's
+# message_count tells us when another process talked to the
+# user in between, in which case the entry is reloaded.
+# =====================================
+
+ENTRY_OVERHEAD = 256    # rough bytes per entry (object, deque, key)
+RECORD_OVERHEAD = 64    # rough bytes per turn / memory tuple
+
+
+class Session:
+
+    __slots__ = (
+        "history", "memories", "memory_limit",
+        "message_count", "day", "expires_at", "size"
+    )
+
+    def __init__(self, history, memories, message_count, day, history_limit, memory_limit, expires_at):
+
+        self.history = deque(history, maxlen=history_limit)    # (role, message)
+        self.memories = list(memories)                          # (id, summary, callback), newest first
+        self.memory_limit = memory_limit
+        self.message_count = message_count
+        self.day = day
+        self.expires_at = expires_at
+        self.size = 0
+
+    def follows(self, message_count, day):
+
+        # True when the only turn since ours was this one
+        return day == self.day and message_count == self.message_count + 1
+
+    def measure(self):
+
+        size = ENTRY_OVERHEAD
+
+        for role, message in self.history:
+            size += RECORD_OVERHEAD + len(role) + len(message)
+
+        for _, summary, callback in self.memories:
+            size += RECORD_OVERHEAD + len(summary) + len(callback or "")
+
+        self.size = size
+
+        return size
+
+
+class SessionCache:
+
+    def __init__(self, max_bytes, ttl):
+
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self._stats = {
+            "hits": 0,
+            "misses": 0,
+            "reloads": 0,       # another process wrote in between
+            "evictions": 0,
+            "expired": 0,
+        }
+
+    def lookup(self, platform, user_id, message_count, day):
+
+        # Called after the turn's upsert: returns (history, memories)
+        # if the cached copy is still current, else None
+        key = (platform, user_id)
+
+        with self._lock:
+
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self._stats["misses"] += 1
+                return None
+
+            if entry.expires_at < time.monotonic():
+                self._drop(key)
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            if not entry.follows(message_count, day):
+                self._drop(key)
+                self._stats["reloads"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            entry.message_count = message_count
+            self._entries.move_to_end(key)
+            self._stats["hits"] += 1
+
+            return list(entry.history), list(entry.memories)
+
+    def is_warm(self, platform, user_id):
+
+        with self._lock:
+
+            if (platform, user_id) in self._entries:
+                return True
+
+            self._stats["misses"] += 1
+
+            return False
+
+    def put(self, platform, user_id, message_count, day, history, memories, history_limit, memory_limit):
+
+        key = (platform, user_id)
+
+        entry = Session(
+            history,
+            memories,
+            message_count,
+            day,
+            history_limit,
+            memory_limit,
+            time.monotonic() + self.ttl
+        )
+
+        with self._lock:
+
+            self._drop(key)
+
+            self._entries[key] = entry
+            self._bytes += entry.measure()
+
+            self._evict()
+
+    def append_turn(self, platform, user_id, role, message):
+
+        with self._lock:
+
+            entry = self._entries.get((platform, user_id))
+
+            if entry is None:
+                return
+
+            self._bytes -= entry.size
+            entry.history.append((role, message))
+            self._bytes += entry.measure()
+
+            self._evict()
+
+    def add_memory(self, platform, user_id, memory):
+
+        with self._lock:
+
+            entry = self._entries.get((platform, user_id))
+
+            if entry is None:
+                return
+
+            self._bytes -= entry.size
+            entry.memories.insert(0, memory)
+            del entry.memories[entry.memory_limit:]
+            self._bytes += entry.measure()
+
+            self._evict()
+
+    def set_callback(self, platform, user_id, memory_id, callback):
+
+        with self._lock:
+
+            entry = self._entries.get((platform, user_id))
+
+            if entry is None:
+                return
+
+            self._bytes -= entry.size
+            entry.memories = [
+                (mid, summary, callback if mid == memory_id else cb)
+                for mid, summary, cb in entry.memories
+            ]
+            self._bytes += entry.measure()
+
+    def invalidate(self, platform, user_id):
+
+        with self._lock:
+            self._drop((platform, user_id))
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+
+        with self._lock:
+
+            lookups = self._stats["hits"] + self._stats["misses"]
+
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "resident_bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hit_ratio": self._stats["hits"] / lookups if lookups else 0.0,
+            }
+
+    def _drop(self, key):
+
+        entry = self._entries.pop(key, None)
+
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def _evict(self):
+
+        now = time.monotonic()
+
+        while self._entries and self._bytes > self.max_bytes:
+
+            key, entry = self._entries.popitem(last=False)
+            self._bytes -= entry.size
+
+            if entry.expires_at < now:
+                self._stats["expired"] += 1
+            else:
+                self._stats["evictions"] += 1
+
+
+session_cache = SessionCache(SESSION_CACHE_BYTES, SESSION_CACHE_TTL)
+
+
+def session_stats():
+    return session_cache.stats()
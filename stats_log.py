@@ -0,0 +1,57 @@
+import os
+import json
+import logging
+import threading
+
+from config import STATS_LOG_INTERVAL
+
+
+# =====================================
+# PERIODIC STATS LOG
+# Every module keeps its own counters behind a *_stats()
+# function; each process logs the ones it uses, one JSON line
+# per section, so hit ratios, queue depths and latencies are
+# visible in production logs.
+# =====================================
+
+_started_pid = None
+_start_lock = threading.Lock()
+
+
+def log_stats(sections):
+
+    for name, collect in sections.items():
+
+        try:
+            stats = collect()
+        except Exception as e:
+            logging.warning("Stats %s unavailable: %s", name, e)
+            continue
+
+        logging.info("Stats %s: %s", name, json.dumps(stats, default=str, sort_keys=True))
+
+
+def start_stats_log(sections, interval=STATS_LOG_INTERVAL):
+
+    # sections: {name: callable returning a dict}; once per process
+    global _started_pid
+
+    if interval <= 0:
+        return None
+
+    with _start_lock:
+
+        if _started_pid == os.getpid():
+            return None
+
+        _started_pid = os.getpid()
+
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            log_stats(sections)
+
+    threading.Thread(target=run, name="stats-log", daemon=True).start()
+
+    return stop
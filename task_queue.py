@@ -0,0 +1,391 @@
+import time
+import signal
+import logging
+import threading
+from datetime import timedelta
+
+import psycopg2
+from psycopg2.extras import Json
+from psycopg.types.json import Jsonb
+
+from config import (
+    TASK_WORKER_THREADS,
+    TASK_POLL_INTERVAL,
+    TASK_MAX_ATTEMPTS,
+    TASK_RETRY_BACKOFF,
+    TASK_VISIBILITY_TIMEOUT,
+    TASK_RETENTION_DAYS
+)
+from db import get_cursor, get_async_cursor
+
+
+# =====================================
+# BACKGROUND TASK QUEUE (Postgres)
+# Work that must not sit on the reply path is enqueued into
+# background_tasks and claimed by workers with
+# FOR UPDATE SKIP LOCKED. At most one pending task exists per
+# (kind, dedup_key); failed tasks are retried with backoff.
+# =====================================
+
+TASK_HANDLERS = {}
+
+
+def register_task(kind):
+
+    def decorator(fn):
+        TASK_HANDLERS[kind] = fn
+        return fn
+
+    return decorator
+
+
+ENQUEUE_SQL = """
+    INSERT INTO background_tasks (kind, dedup_key, payload, run_at)
+    VALUES (%s,%s,%s, NOW() + %s)
+    ON CONFLICT (kind, dedup_key) WHERE status = 'pending'
+    DO NOTHING
+"""
+
+
+def enqueue_task(kind, payload, dedup_key, delay=0):
+
+    try:
+
+        with get_cursor() as cur:
+
+            cur.execute(ENQUEUE_SQL, (kind, dedup_key, Json(payload), timedelta(seconds=delay)))
+
+            return cur.rowcount == 1
+
+    except Exception as e:
+        logging.error("Could not enqueue %s task: %s", kind, e)
+        return False
+
+
+async def enqueue_task_async(kind, payload, dedup_key, delay=0):
+
+    # enqueue_task() for the asyncio engine path (psycopg 3 pool)
+    try:
+
+        async with get_async_cursor() as cur:
+
+            await cur.execute(ENQUEUE_SQL, (kind, dedup_key, Jsonb(payload), timedelta(seconds=delay)))
+
+            return cur.rowcount == 1
+
+    except Exception as e:
+        logging.error("Could not enqueue %s task: %s", kind, e)
+        return False
+
+
+def claim_task():
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            UPDATE background_tasks
+            SET status = 'running',
+                attempts = attempts + 1,
+                started_at = NOW()
+            WHERE id = (
+                SELECT id
+                FROM background_tasks
+                WHERE status = 'pending'
+                AND run_at <= NOW()
+                ORDER BY run_at
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, kind, payload, attempts,
+                EXTRACT(EPOCH FROM NOW() - created_at)
+        """)
+
+        return cur.fetchone()
+
+
+def complete_task(task_id):
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            UPDATE background_tasks
+            SET status = 'done', finished_at = NOW(), last_error = NULL
+            WHERE id = %s
+        """, (task_id,))
+
+
+def fail_task(task_id, attempts, error):
+
+    error = str(error)[:500]
+
+    if attempts < TASK_MAX_ATTEMPTS:
+
+        backoff = timedelta(seconds=TASK_RETRY_BACKOFF * 2 ** (attempts - 1))
+
+        try:
+
+            with get_cursor() as cur:
+
+                cur.execute("""
+                    UPDATE background_tasks
+                    SET status = 'pending', run_at = NOW() + %s, last_error = %s
+                    WHERE id = %s
+                """, (backoff, error, task_id))
+
+            return
+
+        except psycopg2.IntegrityError:
+            # A newer pending task with the same key replaces this retry
+            error = "superseded: " + error
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            UPDATE background_tasks
+            SET status = 'failed', finished_at = NOW(), last_error = %s
+            WHERE id = %s
+        """, (error, task_id))
+
+
+def requeue_stale_tasks():
+
+    # Tasks whose worker died mid-run go back to pending
+    with get_cursor() as cur:
+
+        cur.execute("""
+            UPDATE background_tasks t
+            SET status = CASE WHEN t.attempts < %s THEN 'pending' ELSE 'failed' END,
+                finished_at = CASE WHEN t.attempts < %s THEN NULL ELSE NOW() END,
+                last_error = 'worker timed out'
+            WHERE t.status = 'running'
+            AND t.started_at < NOW() - %s
+            AND NOT EXISTS (
+                SELECT 1
+                FROM background_tasks p
+                WHERE p.kind = t.kind
+                AND p.dedup_key = t.dedup_key
+                AND p.status = 'pending'
+            )
+        """, (
+            TASK_MAX_ATTEMPTS,
+            TASK_MAX_ATTEMPTS,
+            timedelta(seconds=TASK_VISIBILITY_TIMEOUT)
+        ))
+
+        requeued = cur.rowcount
+
+        cur.execute("""
+            DELETE FROM background_tasks
+            WHERE status IN ('done', 'failed')
+            AND finished_at < NOW() - %s
+        """, (timedelta(days=TASK_RETENTION_DAYS),))
+
+    return requeued
+
+
+# =====================================
+# WORKERS
+# =====================================
+
+class TaskWorkerPool:
+
+    def __init__(self, threads, poll_interval):
+
+        self.threads = threads
+        self.poll_interval = poll_interval
+
+        self._stop = threading.Event()
+        self._workers = []
+        self._lock = threading.Lock()
+
+        self._stats = {
+            "processed": 0,
+            "failed": 0,
+            "total_latency_s": 0.0,
+            "max_latency_s": 0.0,
+            "total_run_s": 0.0,
+        }
+
+    def start(self):
+
+        for i in range(self.threads):
+
+            worker = threading.Thread(
+                target=self._run,
+                name=f"task-worker-{i}",
+                daemon=True
+            )
+            worker.start()
+            self._workers.append(worker)
+
+        logging.info("Started %s background task workers", self.threads)
+
+    def stop(self, timeout=30):
+
+        self._stop.set()
+
+        for worker in self._workers:
+            worker.join(timeout)
+
+    def stats(self):
+
+        with self._lock:
+
+            processed = self._stats["processed"]
+
+            return {
+                **self._stats,
+                "avg_latency_s": self._stats["total_latency_s"] / processed if processed else 0.0,
+                "avg_run_s": self._stats["total_run_s"] / processed if processed else 0.0,
+            }
+
+    def _run(self):
+
+        last_reap = 0.0
+
+        while not self._stop.is_set():
+
+            try:
+
+                if time.monotonic() - last_reap > TASK_VISIBILITY_TIMEOUT / 2:
+                    last_reap = time.monotonic()
+                    requeue_stale_tasks()
+
+                task = claim_task()
+
+            except Exception as e:
+                logging.error("Task queue unavailable: %s", e)
+                self._stop.wait(self.poll_interval * 5)
+                continue
+
+            if task is None:
+                self._stop.wait(self.poll_interval)
+                continue
+
+            self._execute(*task)
+
+    def _execute(self, task_id, kind, payload, attempts, queued_for):
+
+        started = time.monotonic()
+        handler = TASK_HANDLERS.get(kind)
+
+        try:
+
+            if handler is None:
+                raise LookupError(f"no handler registered for {kind}")
+
+            handler(payload)
+            complete_task(task_id)
+            ok = True
+
+        except Exception as e:
+
+            logging.error("Task %s (%s) failed: %s", task_id, kind, e)
+            ok = False
+
+            try:
+                fail_task(task_id, attempts, e)
+            except Exception as e2:
+                logging.error("Could not record failure of task %s: %s", task_id, e2)
+
+        elapsed = time.monotonic() - started
+        latency = float(queued_for) + elapsed
+
+        with self._lock:
+            self._stats["processed" if ok else "failed"] += 1
+            if ok:
+                self._stats["total_latency_s"] += latency
+                self._stats["total_run_s"] += elapsed
+                self._stats["max_latency_s"] = max(self._stats["max_latency_s"], latency)
+
+
+_worker_pool = None
+
+
+def start_task_workers(threads=TASK_WORKER_THREADS):
+
+    global _worker_pool
+
+    if _worker_pool is None and threads > 0:
+        _worker_pool = TaskWorkerPool(threads, TASK_POLL_INTERVAL)
+        _worker_pool.start()
+
+    return _worker_pool
+
+
+def queue_stats():
+
+    with get_cursor() as cur:
+
+        cur.execute("""
+            SELECT
+                kind,
+                COUNT(*) FILTER (WHERE status = 'pending'),
+                COUNT(*) FILTER (WHERE status = 'running'),
+                COUNT(*) FILTER (WHERE status = 'failed'),
+                MAX(EXTRACT(EPOCH FROM NOW() - run_at)) FILTER (
+                    WHERE status = 'pending' AND run_at <= NOW()
+                ),
+                AVG(EXTRACT(EPOCH FROM finished_at - created_at)) FILTER (
+                    WHERE status = 'done' AND finished_at > NOW() - INTERVAL '1 hour'
+                )
+            FROM background_tasks
+            GROUP BY kind
+        """)
+
+        rows = cur.fetchall()
+
+    stats = {
+        kind: {
+            "pending": pending,
+            "running": running,
+            "failed": failed,
+            "oldest_due_s": float(oldest or 0),
+            "avg_latency_1h_s": float(latency or 0),
+        }
+        for kind, pending, running, failed, oldest, latency in rows
+    }
+
+    if _worker_pool is not None:
+        stats["workers"] = _worker_pool.stats()
+
+    return stats
+
+
+# =====================================
+# STANDALONE WORKER PROCESS
+# python task_queue.py
+# =====================================
+
+def main():
+
+    # Run as a script this file is __main__; maya_engine registers its
+    # handlers on the importable task_queue module, so the workers and
+    # stats must come from that module too, not from this copy
+    import maya_engine  # registers the task handlers
+    import task_queue
+    from db import init_db
+
+    logging.basicConfig(
+        format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+        level=logging.INFO
+    )
+
+    init_db()
+
+    pool = task_queue.start_task_workers()
+
+    stopping = threading.Event()
+
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, lambda *_: stopping.set())
+
+    while not stopping.wait(60):
+        logging.info("Task queue: %s", task_queue.queue_stats())
+
+    if pool is not None:
+        pool.stop()
+
+
+if __name__ == "__main__":
+    main()
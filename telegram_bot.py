@@ -2,12 +2,22 @@ from telegram.ext import ApplicationBuilder, MessageHandler, filters, ContextTyp
 from telegram import Update
 from telegram.constants import ChatAction
 import random
-
-from config import BOT_TOKEN
-from maya_engine import generate_reply, daily_checkin_message, late_night_checkin_message, proactive_emotional_checkin
-from db import get_db
-
-from datetime import datetime, timedelta, time
+import zlib
+
+from config import BOT_TOKEN, TASK_INPROCESS_WORKERS, CHECKIN_CATCH_UP_HOURS, TELEGRAM_CONCURRENT_UPDATES
+from maya_engine import handle_turn_async, prompt_stats
+from checkin_pool import checkin_pool, pick_checkin, refresh_checkin_pools
+from broadcast import broadcast
+from job_runtime import run_blocking, monitored_job, job_stats
+from db import get_cursor, pool_stats, async_pool_stats
+from llm_client import warmup_llm, warmup_llm_async, llm_stats
+from task_queue import start_task_workers, queue_stats
+from history_writer import history_stats
+from session_cache import session_stats
+from user_state import user_state_stats
+from stats_log import start_stats_log
+
+from datetime import date, datetime, timedelta, time
 import asyncio
 import logging
 
@@ -22,60 +32,38 @@ logging.basicConfig(
 # MESSAGE HANDLER
 # =============================
 
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-
-    user_id = str(update.message.from_user.id)
-    name = update.message.from_user.first_name
-    text = (update.message.text or "").strip()
-
-    conn = get_db()
-    cur = conn.cursor()
-
-    # -----------------------------
-    # CHECK USER
-    # -----------------------------
+# Updates run concurrently (TELEGRAM_CONCURRENT_UPDATES); one user's
+# messages still go through one at a time, in arrival order.
+# user_id -> [lock, updates holding or waiting for it]
+_user_locks = {}
 
-    cur.execute("""
-        SELECT onboarding_completed
-        FROM users
-        WHERE platform='telegram'
-        AND platform_user_id=%s
-    """, (user_id,))
 
-    row = cur.fetchone()
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
-    # -----------------------------
-    # NEW USER
-    # maya_engine will insert them
-    # -----------------------------
+    user_id = str(update.message.from_user.id)
 
-    if row:
+    entry = _user_locks.get(user_id)
 
-        onboarding_completed = row[0]
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
 
-        if not onboarding_completed:
+    entry[1] += 1
 
-            await update.message.reply_text(
-                "Hey 🙂 I'm Maya.\n\n"
-                "You can talk to me about anything — what's going on today?"
-            )
+    try:
+        async with entry[0]:
+            await reply_to_message(update, context, user_id)
 
-            cur.execute("""
-                UPDATE users
-                SET onboarding_completed = TRUE
-                WHERE platform='telegram'
-                AND platform_user_id=%s
-            """, (user_id,))
+    finally:
+        entry[1] -= 1
 
-            conn.commit()
+        if not entry[1]:
+            del _user_locks[user_id]
 
-            cur.close()
-            conn.close()
 
-            return
+async def reply_to_message(update, context, user_id):
 
-    cur.close()
-    conn.close()
+    name = update.message.from_user.first_name
+    text = (update.message.text or "").strip()
 
     # -----------------------------
     # TYPING INDICATOR
@@ -87,25 +75,69 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # -----------------------------
-    # AI GENERATION (non blocking)
+    # AI GENERATION (awaited on the
+    # bot's event loop, no thread)
     # -----------------------------
 
+    partial = {}
+
+    def on_partial(first_sentence):
+
+        # Called as soon as the first sentence has streamed in
+        partial["message"] = asyncio.ensure_future(
+            update.message.reply_text(first_sentence)
+        )
+
     try:
 
-        reply = await asyncio.to_thread(
-            generate_reply,
+        # the engine's user upsert also reports onboarding state
+        result = await handle_turn_async(
             "telegram",
             user_id,
             name,
-            text
+            text,
+            on_partial
         )
 
+        reply = result.text
+
     except Exception as e:
 
         logging.error(e)
 
+        result = None
         reply = "Hmm… thoda issue aa gaya. Ek baar phir bolo?"
 
+    # -----------------------------
+    # ONBOARDING
+    # -----------------------------
+
+    if result is not None and result.onboarding:
+
+        await update.message.reply_text(reply)
+
+        return
+
+    # -----------------------------
+    # PROGRESSIVE DELIVERY
+    # first sentence already sent,
+    # finish it in place
+    # -----------------------------
+
+    if "message" in partial:
+
+        try:
+
+            sent = await partial["message"]
+
+            if sent.text != reply:
+                await sent.edit_text(reply)
+
+            return
+
+        except Exception as e:
+            logging.error(e)
+
     # -----------------------------
     # TYPING SIMULATION
     # -----------------------------
@@ -128,242 +160,285 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # SILENCE DETECTION (48h)
 # =============================
 
-async def silence_check(context: ContextTypes.DEFAULT_TYPE):
+QUIET_MESSAGES = [
+    "hey… aaj thoda quiet ho. sab theek?",
+    "bas randomly check kar raha tha… sab ok?",
+    "aaj ka din kaisa tha?",
+    "pata nahi kyun laga poochu… aaj mood kaisa hai?",
+    "kaafi din se baat nahi hui… sab theek chal raha hai?"
+]
 
-    conn = get_db()
-    cur = conn.cursor()
 
-    threshold = datetime.utcnow() - timedelta(hours=48)
+def telegram_users(condition, params):
 
-    cur.execute("""
-        SELECT platform_user_id
-        FROM users
-        WHERE platform='telegram'
-        AND last_active < %s
-    """, (threshold,))
+    # Rows are fetched up front so the pooled connection is
+    # returned before the (long) broadcast starts
+    with get_cursor() as cur:
 
-    users = cur.fetchall()
+        cur.execute(f"""
+            SELECT platform_user_id
+            FROM users
+            WHERE platform='telegram'
+            AND {condition}
+        """, params)
 
-    for (user_id,) in users:
+        rows = cur.fetchall()
+
+    for (user_id,) in rows:
+        yield user_id
 
-        try:
 
-            quiet_messages = [
-                "hey… aaj thoda quiet ho. sab theek?",
-                "bas randomly check kar raha tha… sab ok?",
-                "aaj ka din kaisa tha?",
-                "pata nahi kyun laga poochu… aaj mood kaisa hai?",
-                "kaafi din se baat nahi hui… sab theek chal raha hai?"
-            ]
-            
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=random.choice(quiet_messages)
-            )
+TOUCH_CHUNK = 1000
+
+
+def touch_users(user_ids):
+
+    # One set-based UPDATE per chunk instead of one round trip per user
+    for i in range(0, len(user_ids), TOUCH_CHUNK):
+
+        with get_cursor() as cur:
 
             cur.execute("""
                 UPDATE users
                 SET last_active = NOW()
                 WHERE platform='telegram'
-                AND platform_user_id=%s
-            """, (user_id,))
+                AND platform_user_id = ANY(%s)
+            """, (list(user_ids[i:i + TOUCH_CHUNK]),))
 
-            conn.commit()
 
-        except Exception as e:
-            logging.error(e)
+@monitored_job
+async def silence_check(context: ContextTypes.DEFAULT_TYPE):
 
-    cur.close()
-    conn.close()
+    now = datetime.utcnow()
+    threshold = now - timedelta(hours=48)
 
+    recipients = (
+        (user_id, random.choice(QUIET_MESSAGES))
+        for user_id in telegram_users("last_active < %s", (threshold,))
+    )
+
+    # Touched per checkpoint batch: the run key changes every 6h,
+    # so a restart in the next bucket must not find them silent
+    await broadcast(
+        context.bot,
+        f"silence_check:{now:%Y-%m-%d}:{now.hour // 6}",
+        recipients,
+        on_checkpoint=touch_users
+    )
 
 
 # =============================
 # WEEKLY MOOD SUMMARY
 # =============================
 
-async def weekly_mood_summary(context: ContextTypes.DEFAULT_TYPE):
+WEEKLY_MOOD_PAGE = 1000
 
-    conn = get_db()
-    cur = conn.cursor()
 
-    one_week_ago = datetime.utcnow() - timedelta(days=7)
-
-    cur.execute("""
-        SELECT DISTINCT platform_user_id
-        FROM mood_logs
-        WHERE platform='telegram'
-        AND created_at >= %s
-    """, (one_week_ago,))
+def weekly_mood_rows(since):
 
-    users = cur.fetchall()
+    # One aggregate over the week, read in keyset pages of users: each
+    # page is its own short transaction, so no pooled connection sits
+    # idle in a transaction while the broadcast sends (no per-user
+    # queries either). Pages walk idx_mood_user_time in user order.
+    after = ""
 
-    for (user_id,) in users:
+    while True:
 
-        try:
+        with get_cursor() as cur:
 
             cur.execute("""
-                SELECT mood_score, mood_label
+                SELECT
+                    platform_user_id,
+                    COUNT(mood_score),
+                    ROUND(AVG(mood_score)::numeric, 1),
+                    mode() WITHIN GROUP (ORDER BY mood_label)
                 FROM mood_logs
                 WHERE platform='telegram'
-                AND platform_user_id=%s
+                AND platform_user_id > %s
                 AND created_at >= %s
-            """, (user_id, one_week_ago))
+                GROUP BY platform_user_id
+                HAVING COUNT(*) >= 5
+                AND COUNT(mood_score) > 0
+                AND COUNT(mood_label) > 0
+                ORDER BY platform_user_id
+                LIMIT %s
+            """, (after, since, WEEKLY_MOOD_PAGE))
 
-            moods = cur.fetchall()
+            rows = cur.fetchall()
 
-            if len(moods) < 5:
-                continue
+        yield from rows
 
-            scores = [m[0] for m in moods if m[0] is not None]
-            labels = [m[1] for m in moods if m[1] is not None]
+        if len(rows) < WEEKLY_MOOD_PAGE:
+            return
 
-            if not scores:
-                continue
+        after = rows[-1][0]
 
-            avg_mood = round(sum(scores) / len(scores), 1)
-            most_common = max(set(labels), key=labels.count)
 
-            message = (
-                "📊 Weekly Reflection 💛\n\n"
-                f"Check-ins: {len(scores)}\n"
-                f"Average mood: {avg_mood}/10\n"
-                f"Most common feeling: {most_common}"
-            )
+@monitored_job
+async def weekly_mood_summary(context: ContextTypes.DEFAULT_TYPE):
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=message
-            )
+    one_week_ago = datetime.utcnow() - timedelta(days=7)
 
-        except Exception as e:
-            logging.error(e)
+    recipients = (
+        (
+            user_id,
+            "📊 Weekly Reflection 💛\n\n"
+            f"Check-ins: {checkins}\n"
+            f"Average mood: {avg_mood}/10\n"
+            f"Most common feeling: {most_common}"
+        )
+        for user_id, checkins, avg_mood, most_common in weekly_mood_rows(one_week_ago)
+    )
 
-    cur.close()
-    conn.close()
+    await broadcast(
+        context.bot,
+        f"weekly_mood_summary:{date.today():%G-W%V}",
+        recipients
+    )
 
 
 # =============================
 # DAILY CHECK-IN
 # =============================
 
+@monitored_job
 async def daily_checkin(context: ContextTypes.DEFAULT_TYPE):
 
-    conn = get_db()
-    cur = conn.cursor()
-
     threshold = datetime.utcnow() - timedelta(days=7)
 
-    cur.execute("""
-        SELECT platform_user_id
-        FROM users
-        WHERE platform='telegram'
-        AND last_active > %s
-    """, (threshold,))
+    recipients = (
+        (user_id, pick_checkin("daily", user_id))
+        for user_id in telegram_users("last_active > %s", (threshold,))
+    )
 
-    users = cur.fetchall()
+    await broadcast(
+        context.bot,
+        f"daily_checkin:{date.today()}",
+        recipients
+    )
 
-    for (user_id,) in users:
 
-        try:
+# =============================
+# LATE NIGHT CHECK-IN
+# =============================
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=daily_checkin_message()
-            )
-            await asyncio.sleep(0.5)
+@monitored_job
+async def late_night_checkin(context: ContextTypes.DEFAULT_TYPE):
 
-        
-        except Exception as e:
-            logging.error(e)
+    threshold = datetime.utcnow() - timedelta(days=7)
+
+    recipients = (
+        (user_id, pick_checkin("late_night", user_id))
+        for user_id in telegram_users("last_active > %s", (threshold,))
+    )
+
+    await broadcast(
+        context.bot,
+        f"late_night_checkin:{date.today()}",
+        recipients
+    )
 
-    cur.close()
-    conn.close()
 
 # =============================
-# LATE NIGHT CHECK-IN
+# EMOTIONAL FOLLOWUP CHECKIN
 # =============================
 
-async def late_night_checkin(context: ContextTypes.DEFAULT_TYPE):
-
-    conn = get_db()
-    cur = conn.cursor()
+FOLLOWUP_SAMPLE_PERCENT = 15
 
-    threshold = datetime.utcnow() - timedelta(days=7)
 
-    cur.execute("""
-        SELECT platform_user_id
-        FROM users
-        WHERE platform='telegram'
-        AND last_active > %s
-    """, (threshold,))
+@monitored_job
+async def emotional_followup(context):
 
-    users = cur.fetchall()
+    now = datetime.utcnow()
+    threshold = now - timedelta(hours=8)
+    run_key = f"emotional_followup:{now:%Y-%m-%d}:{now.hour // 12}"
 
-    for (user_id,) in users:
+    # 15% sample drawn from the run key, so a resumed run picks the
+    # same users instead of adding a fresh random 15%
+    recipients = (
+        (user_id, pick_checkin("proactive", user_id))
+        for user_id in telegram_users("last_active < %s", (threshold,))
+        if zlib.crc32(f"{run_key}:{user_id}".encode()) % 100 < FOLLOWUP_SAMPLE_PERCENT
+    )
 
-        try:
+    await broadcast(
+        context.bot,
+        run_key,
+        recipients
+    )
 
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=late_night_checkin_message()
-            )
 
-            await asyncio.sleep(0.5)
-            
+# =============================
+# CHECK-IN POOL REFRESH
+# =============================
 
-        except Exception as e:
-            logging.error(e)
+@monitored_job
+async def refresh_checkins(context: ContextTypes.DEFAULT_TYPE):
 
-    cur.close()
-    conn.close()
+    # One batched LLM call per stale category, on the job executor
+    await run_blocking(refresh_checkin_pools)
 
 
 # =============================
-# EMOTIONAL FOLLOWUP CHECKIN
+# START BOT
 # =============================
 
-async def emotional_followup(context):
+DAILY_CHECKIN_AT = time(hour=19, minute=0)
+LATE_NIGHT_CHECKIN_AT = time(hour=23, minute=30)
 
-    conn = get_db()
-    cur = conn.cursor()
+CATCH_UP_DELAY = 90     # after warmup / pool refresh
 
-    threshold = datetime.utcnow() - timedelta(hours=8)
 
-    cur.execute("""
-        SELECT platform_user_id
-        FROM users
-        WHERE platform='telegram'
-        AND last_active < %s
-    """, (threshold,))
+def schedule_catch_up(job_queue, callback, at):
 
-    users = cur.fetchall()
+    # run_daily never fires for a time that passed while the bot
+    # was down. If today's slot is behind us (and within the
+    # catch-up window), run the job once now: it reuses today's run
+    # key, so chats already delivered before the restart are skipped.
+    now = datetime.utcnow()
+    scheduled = datetime.combine(now.date(), at)
 
-    for (user_id,) in users:
+    if not scheduled <= now < scheduled + timedelta(hours=CHECKIN_CATCH_UP_HOURS):
+        return
 
-        try:
+    logging.info("Catching up %s (scheduled %s UTC)", callback.__name__, at)
 
-            if random.random() < 0.15:
+    job_queue.run_once(callback, when=CATCH_UP_DELAY, name=f"{callback.__name__}:catch_up")
 
-                await context.bot.send_message(
-                    chat_id=user_id,
-                    text=proactive_emotional_checkin()
-                )
 
-        except Exception:
-            pass
+async def on_startup(app):
 
-    cur.close()
-    conn.close()
-    
+    # keep-alive connections for the async engine path (bot's loop)
+    await warmup_llm_async()
 
-# =============================
-# START BOT
-# =============================
 
 def start():
 
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    warmup_llm()
+
+    # memory extraction / summaries (more capacity: python task_queue.py)
+    start_task_workers(TASK_INPROCESS_WORKERS)
+
+    start_stats_log({
+        "db_pool": pool_stats,
+        "db_async_pool": async_pool_stats,
+        "history": history_stats,
+        "llm": llm_stats,
+        "session_cache": session_stats,
+        "user_state": user_state_stats,
+        "prompt": prompt_stats,
+        "task_queue": queue_stats,
+        "jobs": job_stats,
+        "checkin_pool": checkin_pool.stats,
+    })
+
+    app = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(TELEGRAM_CONCURRENT_UPDATES)
+        .post_init(on_startup)
+        .build()
+    )
 
     app.add_handler(
         MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message)
@@ -386,15 +461,18 @@ def start():
     # daily emotional check-in
     app.job_queue.run_daily(
         daily_checkin,
-        time=time(hour=19, minute=0)
+        time=DAILY_CHECKIN_AT
     )
 
     # late night emotional check-in
     app.job_queue.run_daily(
         late_night_checkin,
-        time=time(hour=23, minute=30)
+        time=LATE_NIGHT_CHECKIN_AT
     )
 
+    schedule_catch_up(app.job_queue, daily_checkin, DAILY_CHECKIN_AT)
+    schedule_catch_up(app.job_queue, late_night_checkin, LATE_NIGHT_CHECKIN_AT)
+
     # emotional followup check-in
     app.job_queue.run_repeating(
         emotional_followup,
@@ -402,6 +480,13 @@ def start():
         first=300
     )
 
+    # keep check-in message pools fresh (refreshes only stale ones)
+    app.job_queue.run_repeating(
+        refresh_checkins,
+        interval=3600,
+        first=30
+    )
+
     print("Telegram bot running...")
 
     app.run_polling(drop_pending_updates=True)
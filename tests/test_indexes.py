@@ -0,0 +1,184 @@
+import os
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+psycopg2 = pytest.importorskip("psycopg2")
+pytest.importorskip("psycopg_pool")
+pytest.importorskip("dotenv")
+
+import db
+
+
+# =====================================
+# Query plans for the per-user lookups (migration 1).
+# Needs a throwaway local Postgres: TEST_DATABASE_URL, default
+# postgresql://localhost/maya_test. Skipped when unreachable.
+# Everything lives in its own schema, dropped afterwards.
+# =====================================
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "postgresql://localhost/maya_test")
+SCHEMA = f"maya_plan_test_{os.getpid()}"
+
+
+@pytest.fixture(scope="module")
+def conn():
+
+    try:
+        conn = psycopg2.connect(TEST_DATABASE_URL, connect_timeout=3)
+    except psycopg2.OperationalError as e:
+        pytest.skip(f"no local Postgres at {TEST_DATABASE_URL}: {e}")
+
+    conn.autocommit = True
+    cur = conn.cursor()
+
+    cur.execute(f"CREATE SCHEMA {SCHEMA}")
+    cur.execute(f"SET search_path TO {SCHEMA}")
+
+    try:
+
+        db._create_tables(cur)
+        db._apply_migrations(conn)
+
+        _seed(cur)
+
+        # The plan must show the index can serve the filter and the
+        # order; table size alone should not decide that here
+        cur.execute("SET enable_seqscan = off")
+
+        yield conn
+
+    finally:
+        conn.autocommit = True
+        cur.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+        conn.close()
+
+
+def _seed(cur):
+
+    now = datetime.utcnow()
+
+    for user in range(50):
+
+        uid = str(user)
+
+        cur.execute("""
+            INSERT INTO users (platform, platform_user_id, name, last_active, premium_expires_at)
+            VALUES ('telegram', %s, 'u', %s, %s)
+        """, (uid, now - timedelta(hours=user), now + timedelta(days=1) if user % 10 == 0 else None))
+
+        for i in range(40):
+
+            at = now - timedelta(minutes=i)
+
+            cur.execute("""
+                INSERT INTO conversation_history (platform, platform_user_id, role, message, created_at)
+                VALUES ('telegram', %s, 'user', 'hi', %s)
+            """, (uid, at))
+
+            cur.execute("""
+                INSERT INTO mood_logs (platform, platform_user_id, mood_score, mood_label, created_at)
+                VALUES ('telegram', %s, 5, 'ok', %s)
+            """, (uid, at))
+
+        for i in range(10):
+            cur.execute("""
+                INSERT INTO user_memory (platform, platform_user_id, summary, created_at)
+                VALUES ('telegram', %s, 'likes tea', %s)
+            """, (uid, now - timedelta(days=i)))
+
+    cur.execute("ANALYZE")
+
+
+def plan(conn, sql, params=()):
+
+    cur = conn.cursor()
+    cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+    result = cur.fetchone()[0]
+    cur.close()
+
+    if isinstance(result, str):
+        result = json.loads(result)
+
+    return json.dumps(result[0]["Plan"])
+
+
+def test_recent_history_uses_index_without_sort(conn):
+
+    text = plan(conn, """
+        SELECT role, message
+        FROM conversation_history
+        WHERE platform=%s AND platform_user_id=%s
+        ORDER BY created_at DESC
+        LIMIT 8
+    """, ("telegram", "7"))
+
+    assert "idx_history_user_time" in text
+    assert '"Node Type": "Sort"' not in text
+
+
+def test_memories_use_index_without_sort(conn):
+
+    text = plan(conn, """
+        SELECT id, summary, callback
+        FROM user_memory
+        WHERE platform=%s AND platform_user_id=%s
+        ORDER BY created_at DESC
+        LIMIT 6
+    """, ("telegram", "7"))
+
+    assert "idx_memory_user_time" in text
+    assert '"Node Type": "Sort"' not in text
+
+
+def test_weekly_mood_range_uses_index(conn):
+
+    text = plan(conn, """
+        SELECT platform_user_id, COUNT(*)
+        FROM mood_logs
+        WHERE platform='telegram'
+        AND created_at >= %s
+        GROUP BY platform_user_id
+    """, (datetime.utcnow() - timedelta(days=7),))
+
+    assert "idx_mood_platform_time" in text or "idx_mood_user_time" in text
+
+
+def test_scheduled_user_scans_use_partial_indexes(conn):
+
+    text = plan(conn, """
+        SELECT platform_user_id
+        FROM users
+        WHERE platform='telegram'
+        AND last_active < %s
+    """, (datetime.utcnow() - timedelta(hours=48),))
+
+    assert "idx_users_telegram_last_active" in text
+
+    text = plan(conn, """
+        SELECT 1
+        FROM users
+        WHERE premium_expires_at IS NOT NULL
+        AND premium_expires_at < NOW()
+    """)
+
+    assert "idx_users_premium_expiry" in text
+
+
+def test_migrations_leave_only_valid_indexes(conn):
+
+    cur = conn.cursor()
+
+    cur.execute("""
+        SELECT c.relname
+        FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s
+        AND NOT i.indisvalid
+    """, (SCHEMA,))
+
+    assert cur.fetchall() == []
+
+    cur.close()
@@ -0,0 +1,109 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("httpx")
+pytest.importorskip("dotenv")
+
+from llm_client import LLMClient, ModelRouter
+
+
+# =====================================
+# Stand-in OpenAI-style server: each model either answers with
+# its own name or fails with the configured HTTP status
+# =====================================
+
+class StandIn:
+
+    def __init__(self):
+        self.status = {}
+        self.calls = []
+
+
+def _handler(state):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            model = body["model"]
+            state.calls.append(model)
+
+            status = state.status.get(model, 200)
+            payload = json.dumps({"choices": [{"message": {"content": model}}]}).encode()
+
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+@pytest.fixture
+def stand_in():
+
+    state = StandIn()
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _handler(state))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    state.url = f"http://127.0.0.1:{server.server_port}"
+
+    yield state
+
+    server.shutdown()
+
+
+def make_router(url, reset=0.1):
+
+    client = LLMClient(url, "test", 4, 1, 2)
+
+    return ModelRouter(client, ["a", "b"], 0.5, 3, 1, reset)
+
+
+def test_fallback_recovers_after_primary_kept_answering(stand_in):
+
+    router = make_router(stand_in.url)
+
+    # both fail once: both breakers open
+    stand_in.status = {"a": 500, "b": 500}
+    assert router.complete([{"role": "user", "content": "hi"}]) is None
+    assert router.stats()["breakers"] == {"a": "open", "b": "open"}
+
+    # both healthy again; the primary answers every call, the fallback
+    # is never started (and must not lose its half-open probe slot)
+    stand_in.status = {}
+    time.sleep(0.15)
+
+    for _ in range(3):
+        assert router.complete([{"role": "user", "content": "hi"}]) == "a"
+
+    # primary goes down: the fallback has to be tried and answer
+    stand_in.status = {"a": 500}
+    time.sleep(0.15)
+
+    assert router.complete([{"role": "user", "content": "hi"}]) == "b"
+    assert router.stats()["breakers"]["b"] == "closed"
+
+
+def test_open_breaker_is_skipped_not_called(stand_in):
+
+    router = make_router(stand_in.url, reset=60)
+
+    stand_in.status = {"a": 500}
+    assert router.complete([{"role": "user", "content": "hi"}]) == "b"
+
+    stand_in.calls.clear()
+
+    assert router.complete([{"role": "user", "content": "hi"}]) == "b"
+    assert stand_in.calls == ["b"]
@@ -0,0 +1,52 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+pytest.importorskip("psycopg2")
+pytest.importorskip("dotenv")
+
+from user_state import UserStateCache, FREE_NUDGE_AT
+
+
+def make_cache(local_platforms=("telegram",)):
+
+    cache = UserStateCache(60, 100, 3600, 2, local_platforms)
+    cache._ensure_started = lambda: None     # no background flush thread / DB
+
+    return cache
+
+
+def test_only_single_process_platforms_count_locally():
+
+    cache = make_cache()
+    today = date.today()
+
+    cache.sync("telegram", "1", 3, today, False)
+    cache.sync("whatsapp", "1", 3, today, False)
+
+    assert cache.reserve("telegram", "1", today) == (4, False)
+    assert cache.reserve("whatsapp", "1", today) is None
+
+
+def test_turns_near_the_nudge_go_to_the_db():
+
+    cache = make_cache()
+    today = date.today()
+
+    cache.sync("telegram", "1", FREE_NUDGE_AT - 3, today, False)
+
+    assert cache.reserve("telegram", "1", today) == (FREE_NUDGE_AT - 2, False)
+    assert cache.reserve("telegram", "1", today) is None
+    assert cache.take_pending("telegram", "1", today) == 1
+
+
+def test_premium_entry_ends_at_expiry():
+
+    cache = make_cache()
+    today = date.today()
+
+    cache.sync("telegram", "1", 50, today, True, datetime.utcnow() + timedelta(hours=1))
+    cache.sync("telegram", "2", 50, today, True, datetime.utcnow() - timedelta(seconds=1))
+
+    assert cache.reserve("telegram", "1", today) == (51, True)
+    assert cache.reserve("telegram", "2", today) is None
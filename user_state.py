@@ -0,0 +1,309 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+
+from psycopg2.extras import execute_values
+
+from config import (
+    USER_STATE_TTL,
+    USER_STATE_MAX_ENTRIES,
+    USER_STATE_FLUSH_INTERVAL,
+    USER_STATE_SYNC_MARGIN,
+    USER_STATE_LOCAL_PLATFORMS
+)
+from db import get_cursor
+
+
+# =====================================
+# QUOTA / PREMIUM STATE CACHE
+# Per-process copy of each user's daily message_count and
+# is_premium. Turns far from the free-tier thresholds are
+# counted locally and the increments are written back in
+# batches; turns near the nudge or the limit, blocked users,
+# a new day, expired or invalidated entries all go through the
+# DB upsert, which stays the source of truth.
+#
+# Local counting is only sound when a single process serves all of
+# a platform's turns (USER_STATE_LOCAL_PLATFORMS): two processes
+# counting the same user would each see part of the total, and the
+# session cache's message_count check relies on the same guarantee.
+# Invalidation is per process too, so a cached flag must stay safe
+# without it: a stale "free" entry only serves turns away from the
+# thresholds (behaviour identical to premium there), and a premium
+# entry stops at its premium_expires_at.
+# =====================================
+
+FREE_NUDGE_AT = 20      # "10 messages left" nudge
+FREE_DAILY_LIMIT = 30   # free tier blocked from here
+
+
+class UserState:
+
+    __slots__ = ("count", "pending", "day", "is_premium", "premium_until", "expires_at")
+
+    def __init__(self, count, day, is_premium, premium_until, expires_at):
+
+        self.count = count          # today's message_count incl. this process's unsaved turns
+        self.pending = 0            # turns counted here, not yet in users.message_count
+        self.day = day
+        self.is_premium = is_premium
+        self.premium_until = premium_until  # users.premium_expires_at (naive UTC) or None
+        self.expires_at = expires_at
+
+
+class UserStateCache:
+
+    def __init__(self, ttl, max_entries, flush_interval, margin, local_platforms):
+
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.flush_interval = flush_interval
+        self.margin = margin
+        self.local_platforms = frozenset(local_platforms)
+
+        self._entries = OrderedDict()
+        self._orphans = defaultdict(int)    # (platform, user_id, day) -> unsaved turns of dropped entries
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+        self._stats = {
+            "local": 0,         # turns served without a DB round trip
+            "synced": 0,        # turns that went through the upsert
+            "invalidations": 0,
+            "flushed": 0,
+            "flush_batches": 0,
+            "flush_failures": 0,
+        }
+
+    def reserve(self, platform, user_id, day):
+
+        # Counts this turn locally and returns (message_count, is_premium),
+        # or None when the DB has to decide
+        if platform not in self.local_platforms:
+            return None
+
+        key = (platform, user_id)
+
+        with self._lock:
+
+            self._ensure_started()
+
+            entry = self._entries.get(key)
+
+            if entry is None:
+                return None
+
+            if entry.expires_at < time.monotonic() or entry.day != day or self._premium_lapsed(entry):
+                self._drop(key)
+                return None
+
+            count = entry.count + 1
+
+            if not entry.is_premium and not self._far_from_threshold(count - 1):
+                return None
+
+            entry.count = count
+            entry.pending += 1
+            self._entries.move_to_end(key)
+            self._stats["local"] += 1
+
+            return count, entry.is_premium
+
+    def take_pending(self, platform, user_id, day):
+
+        # Unsaved local turns are folded into the caller's upsert
+        with self._lock:
+
+            entry = self._entries.get((platform, user_id))
+            pending = 0
+
+            if entry is not None and entry.day == day:
+                pending = entry.pending
+                entry.pending = 0
+
+            return pending + self._orphans.pop((platform, user_id, day), 0)
+
+    def give_back(self, platform, user_id, day, pending):
+
+        if pending:
+            with self._lock:
+                self._orphans[(platform, user_id, day)] += pending
+
+    def sync(self, platform, user_id, count, day, is_premium, premium_until=None):
+
+        key = (platform, user_id)
+
+        with self._lock:
+
+            self._stats["synced"] += 1
+
+            if platform not in self.local_platforms:
+                return
+
+            entry = self._entries.get(key)
+
+            if entry is not None and entry.day == day:
+                entry.count = count + entry.pending
+                entry.is_premium = is_premium
+                entry.premium_until = premium_until
+                entry.expires_at = time.monotonic() + self.ttl
+            else:
+                self._drop(key)
+                self._entries[key] = UserState(count, day, is_premium, premium_until, time.monotonic() + self.ttl)
+
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, platform, user_id):
+
+        with self._lock:
+            self._drop((platform, user_id))
+            self._stats["invalidations"] += 1
+
+    def invalidate_all(self):
+
+        with self._lock:
+
+            for key in list(self._entries):
+                self._drop(key)
+
+            self._stats["invalidations"] += 1
+
+    def flush(self):
+
+        with self._flush_lock:
+
+            with self._lock:
+
+                batch = defaultdict(int, self._orphans)
+                self._orphans.clear()
+
+                for (platform, user_id), entry in self._entries.items():
+                    if entry.pending:
+                        batch[(platform, user_id, entry.day)] += entry.pending
+                        entry.pending = 0
+
+            if not batch:
+                return 0
+
+            rows = [(p, u, d, n) for (p, u, d), n in batch.items()]
+
+            try:
+
+                with get_cursor() as cur:
+
+                    execute_values(cur, """
+                        UPDATE users u
+                        SET message_count = u.message_count + v.delta,
+                            last_active = NOW()
+                        FROM (VALUES %s) AS v(platform, platform_user_id, day, delta)
+                        WHERE u.platform = v.platform
+                        AND u.platform_user_id = v.platform_user_id
+                        AND u.last_reset = v.day
+                    """, rows, template="(%s, %s, %s::date, %s)", page_size=len(rows))
+
+            except Exception as e:
+
+                logging.error("User state flush failed (%s users): %s", len(rows), e)
+
+                with self._lock:
+                    for key, n in batch.items():
+                        self._orphans[key] += n
+                    self._stats["flush_failures"] += 1
+
+                return 0
+
+            with self._lock:
+                self._stats["flushed"] += sum(batch.values())
+                self._stats["flush_batches"] += 1
+
+            return len(rows)
+
+    def close(self):
+
+        self._stop.set()
+        self.flush()
+
+    def stats(self):
+
+        with self._lock:
+
+            turns = self._stats["local"] + self._stats["synced"]
+
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "pending": sum(e.pending for e in self._entries.values()) + sum(self._orphans.values()),
+                "local_ratio": self._stats["local"] / turns if turns else 0.0,
+            }
+
+    def _far_from_threshold(self, message_count):
+
+        # message_count as generate_reply sees it (before this turn)
+        if message_count < FREE_NUDGE_AT - self.margin:
+            return True
+
+        return FREE_NUDGE_AT < message_count < FREE_DAILY_LIMIT - self.margin
+
+    @staticmethod
+    def _premium_lapsed(entry):
+        return entry.is_premium and entry.premium_until is not None and entry.premium_until < datetime.utcnow()
+
+    def _drop(self, key):
+
+        entry = self._entries.pop(key, None)
+
+        if entry is not None and entry.pending:
+            self._orphans[(key[0], key[1], entry.day)] += entry.pending
+
+    def _ensure_started(self):
+
+        # A forked child must not re-flush its parent's counters
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._entries.clear()
+            self._orphans.clear()
+            self._thread = None
+
+        if self._thread is None and not self._stop.is_set():
+            self._thread = threading.Thread(target=self._run, name="user-state-flush", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+
+
+user_state = UserStateCache(
+    USER_STATE_TTL,
+    USER_STATE_MAX_ENTRIES,
+    USER_STATE_FLUSH_INTERVAL,
+    USER_STATE_SYNC_MARGIN,
+    USER_STATE_LOCAL_PLATFORMS
+)
+
+atexit.register(user_state.close)
+
+
+def invalidate_user_state(platform=None, user_id=None):
+
+    # platform/user_id: one user; no arguments: everyone.
+    # This process only; other processes rely on the bounds above
+    if platform is None:
+        user_state.invalidate_all()
+    else:
+        user_state.invalidate(platform, user_id)
+
+
+def user_state_stats():
+    return user_state.stats()
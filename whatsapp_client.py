@@ -0,0 +1,192 @@
+import os
+import time
+import random
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    WHATSAPP_TOKEN,
+    PHONE_NUMBER_ID,
+    WHATSAPP_SEND_RATE,
+    WHATSAPP_SEND_BURST,
+    WHATSAPP_SEND_PROCESSES,
+    WHATSAPP_SEND_RETRIES,
+    WHATSAPP_POOL_SIZE,
+    WHATSAPP_CONNECT_TIMEOUT,
+    WHATSAPP_READ_TIMEOUT
+)
+from rate_limit import TokenBucket
+
+
+# =====================================
+# WHATSAPP CLOUD API CLIENT
+# Keep-alive session, per-number token bucket (this process's
+# share of it), retries with backoff on 429 / 5xx / network
+# errors, send metrics.
+# =====================================
+
+class WhatsAppClient:
+
+    def __init__(self, token, phone_number_id, rate, burst, retries, pool_size, timeout):
+
+        self.url = f"https://graph.facebook.com/v19.0/{phone_number_id}/messages"
+        self.retries = retries
+        self.timeout = timeout
+        self.pid = os.getpid()
+
+        self.bucket = TokenBucket(rate, burst)
+
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=0
+        )
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.headers.update({
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/json",
+        })
+
+        self._lock = threading.Lock()
+        self._stats = {
+            "sent": 0,
+            "failed": 0,
+            "retries": 0,
+            "throttled": 0,
+            "server_errors": 0,
+            "network_errors": 0,
+            "total_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+        }
+
+    def send_text(self, to, body):
+
+        payload = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": body}
+        }
+
+        started = time.monotonic()
+
+        for attempt in range(self.retries + 1):
+
+            if attempt:
+                self._count("retries")
+
+            self.bucket.acquire()
+
+            try:
+
+                response = self.session.post(self.url, json=payload, timeout=self.timeout)
+
+            except requests.RequestException as e:
+
+                logging.warning("WhatsApp send to %s failed: %s", to, e)
+                self._count("network_errors")
+
+            else:
+
+                if response.status_code < 300:
+                    self._record(True, started)
+                    return True
+
+                if response.status_code == 429:
+                    # The penalty holds back this sender and every other
+                    # one; the next acquire() does the waiting
+                    self._count("throttled")
+                    self.bucket.penalize(_retry_after(response) or 1.0)
+                    continue
+
+                elif response.status_code >= 500:
+                    self._count("server_errors")
+
+                else:
+                    logging.error(
+                        "WhatsApp send to %s rejected: %s %s",
+                        to, response.status_code, response.text[:300]
+                    )
+                    break
+
+            if attempt < self.retries:
+                time.sleep(0.5 * 2 ** attempt + random.uniform(0, 0.25))
+
+        self._record(False, started)
+        return False
+
+    def stats(self):
+
+        with self._lock:
+
+            done = self._stats["sent"] + self._stats["failed"]
+
+            return {
+                **self._stats,
+                "avg_latency_ms": self._stats["total_latency_ms"] / done if done else 0.0,
+                "error_rate": self._stats["failed"] / done if done else 0.0,
+            }
+
+    def _record(self, ok, started):
+
+        elapsed_ms = (time.monotonic() - started) * 1000
+
+        with self._lock:
+            self._stats["sent" if ok else "failed"] += 1
+            self._stats["total_latency_ms"] += elapsed_ms
+            self._stats["max_latency_ms"] = max(self._stats["max_latency_ms"], elapsed_ms)
+
+    def _count(self, key):
+
+        with self._lock:
+            self._stats[key] += 1
+
+
+def _retry_after(response):
+
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_whatsapp_client():
+
+    global _client
+
+    client = _client
+
+    if client is not None and client.pid == os.getpid():
+        return client
+
+    with _client_lock:
+
+        if _client is None or _client.pid != os.getpid():
+            # Every sending process has its own bucket; together
+            # they stay within the number's limit
+            processes = max(WHATSAPP_SEND_PROCESSES, 1)
+
+            _client = WhatsAppClient(
+                WHATSAPP_TOKEN,
+                PHONE_NUMBER_ID,
+                WHATSAPP_SEND_RATE / processes,
+                max(WHATSAPP_SEND_BURST / processes, 1.0),
+                WHATSAPP_SEND_RETRIES,
+                WHATSAPP_POOL_SIZE,
+                (WHATSAPP_CONNECT_TIMEOUT, WHATSAPP_READ_TIMEOUT)
+            )
+
+        return _client
+
+
+def whatsapp_stats():
+    return get_whatsapp_client().stats()
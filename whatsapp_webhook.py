@@ -1,12 +1,26 @@
-import requests
+import os
+import zlib
+import queue
+import atexit
 import random
 import time
 import logging
+import threading
+from collections import namedtuple
 
 from flask import request, jsonify
 
-from config import WHATSAPP_VERIFY_TOKEN, WHATSAPP_TOKEN, PHONE_NUMBER_ID
-from maya_engine import generate_reply
+from config import (
+    WHATSAPP_VERIFY_TOKEN,
+    WHATSAPP_WORKERS,
+    WHATSAPP_QUEUE_SIZE,
+    DEDUP_LRU_SIZE,
+    DEDUP_TTL_HOURS,
+    DEDUP_CLEANUP_INTERVAL
+)
+from maya_engine import handle_turn
+from message_dedup import MessageDeduplicator
+from whatsapp_client import get_whatsapp_client
 
 
 logging.basicConfig(level=logging.INFO)
@@ -14,37 +28,61 @@ logging.basicConfig(level=logging.INFO)
 
 def send_whatsapp_message(user_id, message):
 
-    url = f"https://graph.facebook.com/v19.0/{PHONE_NUMBER_ID}/messages"
+    # Pooled, rate-limited, retried (see whatsapp_client)
+    return get_whatsapp_client().send_text(user_id, message)
 
-    headers = {
-        "Authorization": f"Bearer {WHATSAPP_TOKEN}",
-        "Content-Type": "application/json"
-    }
 
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": user_id,
-        "type": "text",
-        "text": {"body": message}
-    }
+# ---------------------------------
+# PAYLOAD PARSING
+# Meta may batch several entries /
+# changes / messages / statuses into
+# one delivery; every one is yielded.
+# ---------------------------------
 
-    requests.post(url, headers=headers, json=payload)
+InboundMessage = namedtuple("InboundMessage", ["message_id", "user_id", "name", "raw"])
+StatusUpdate = namedtuple("StatusUpdate", ["message_id", "recipient_id", "status"])
 
 
-def parse_whatsapp_message(data):
+def iter_whatsapp_events(data):
 
-    try:
+    for entry in (data or {}).get("entry") or []:
+
+        for change in entry.get("changes") or []:
+
+            value = change.get("value") or {}
+
+            names = {
+                c.get("wa_id"): (c.get("profile") or {}).get("name")
+                for c in value.get("contacts") or []
+            }
+
+            for message in value.get("messages") or []:
+
+                user_id = message.get("from")
+
+                if not user_id:
+                    continue
+
+                yield InboundMessage(
+                    message.get("id"),
+                    user_id,
+                    names.get(user_id) or "User",
+                    message
+                )
+
+            for status in value.get("statuses") or []:
 
-        entry = data["entry"][0]
-        change = entry["changes"][0]
-        value = change["value"]
+                yield StatusUpdate(
+                    status.get("id"),
+                    status.get("recipient_id"),
+                    status.get("status")
+                )
 
-        if "messages" not in value:
-            return None, None, None
 
-        message = value["messages"][0]
+def message_text(message):
+
+    try:
 
-        user_id = message["from"]
         message_type = message.get("type")
 
         text = None
@@ -68,15 +106,187 @@ def parse_whatsapp_message(data):
         elif message_type == "image":
             text = message["image"].get("caption", "image")
 
-        if not text:
-            text = "..."
+    except Exception as e:
+
+        logging.error("Parsing error: %s", e)
+        text = None
+
+    return text or "..."
+
+
+def coalesce_messages(messages):
+
+    # Consecutive messages from one sender become one turn:
+    # [(user_id, name, text, [message_ids])]
+    turns = []
 
-        return user_id, "User", text
+    for m in messages:
+
+        text = message_text(m.raw)
+
+        if turns and turns[-1][0] == m.user_id:
+            turns[-1][2].append(text)
+            turns[-1][3].append(m.message_id)
+        else:
+            turns.append((m.user_id, m.name, [text], [m.message_id]))
+
+    return [(u, n, "\n".join(texts), ids) for u, n, texts, ids in turns]
+
+
+# ---------------------------------
+# INBOUND PROCESSING
+# generation, typing delay and send
+# run on worker threads, never in
+# the webhook request
+# ---------------------------------
+
+def process_inbound(user_id, name, message, received_at):
+
+    onboarding = False
+
+    try:
+
+        result = handle_turn(
+            "whatsapp",
+            user_id,
+            name,
+            message
+        )
+
+        reply, onboarding = result.text, result.onboarding
 
     except Exception as e:
 
-        logging.error("Parsing error: %s", e)
-        return None, None, None
+        logging.error(e)
+        reply = "Hmm… thoda issue aa gaya. Ek baar phir bolo?"
+
+    # simulated typing, minus the time generation already took
+    # (the onboarding intro goes out right away)
+    delay = random.uniform(1.5, 3.5) - (time.monotonic() - received_at)
+
+    if delay > 0 and not onboarding:
+        time.sleep(delay)
+
+    send_whatsapp_message(user_id, reply)
+
+
+class InboundDispatcher:
+
+    # One queue per worker, chosen by sender, so messages from
+    # the same user are always handled in arrival order
+
+    def __init__(self, workers, max_queue):
+
+        self.workers = workers
+        self.max_queue = max_queue
+
+        self._queues = []
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+        self._stats = {"accepted": 0, "rejected": 0, "processed": 0, "failed": 0}
+
+    def submit(self, user_id, name, message):
+
+        self._ensure_started()
+
+        index = zlib.crc32(user_id.encode()) % self.workers
+
+        try:
+            self._queues[index].put_nowait((user_id, name, message, time.monotonic()))
+        except queue.Full:
+            self._count("rejected")
+            return False
+
+        self._count("accepted")
+        return True
+
+    def close(self, timeout=30):
+
+        if self._pid != os.getpid():
+            return
+
+        deadline = time.monotonic() + timeout
+
+        # drain what is queued, then stop
+        for q in self._queues:
+            try:
+                q.put(None, timeout=max(0, deadline - time.monotonic()))
+            except queue.Full:
+                pass
+
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
+
+    def stats(self):
+
+        with self._lock:
+            return {
+                **self._stats,
+                "queue_depth": sum(q.qsize() for q in self._queues),
+                "workers": self.workers,
+            }
+
+    def _ensure_started(self):
+
+        if self._pid == os.getpid():
+            return
+
+        with self._lock:
+
+            if self._pid == os.getpid():
+                return
+
+            per_worker = max(1, self.max_queue // self.workers)
+
+            self._queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+            self._threads = [
+                threading.Thread(target=self._run, args=(q,), name=f"whatsapp-{i}", daemon=True)
+                for i, q in enumerate(self._queues)
+            ]
+
+            for t in self._threads:
+                t.start()
+
+            self._pid = os.getpid()
+
+    def _run(self, q):
+
+        while True:
+
+            job = q.get()
+
+            if job is None:
+                return
+
+            try:
+                process_inbound(*job)
+                self._count("processed")
+            except Exception as e:
+                logging.error("WhatsApp worker error: %s", e)
+                self._count("failed")
+
+    def _count(self, key):
+
+        with self._lock:
+            self._stats[key] += 1
+
+
+inbound_dispatcher = InboundDispatcher(WHATSAPP_WORKERS, WHATSAPP_QUEUE_SIZE)
+
+inbound_dedup = MessageDeduplicator(
+    "whatsapp",
+    DEDUP_LRU_SIZE,
+    DEDUP_TTL_HOURS,
+    DEDUP_CLEANUP_INTERVAL
+)
+
+atexit.register(inbound_dispatcher.close)
+
+
+def dedup_stats():
+    return inbound_dedup.stats()
 
 
 # ---------------------------------
@@ -102,29 +312,40 @@ def register_whatsapp_routes(app):
 
         data = request.json
 
-        user_id, name, message = parse_whatsapp_message(data)
+        messages = []
 
-        if not user_id:
+        for event in iter_whatsapp_events(data):
+
+            if isinstance(event, StatusUpdate):
+                logging.debug("WhatsApp status %s: %s", event.message_id, event.status)
+                continue
+
+            # redeliveries are dropped before their content is parsed
+            if event.message_id and not inbound_dedup.first_delivery(event.message_id):
+                continue
+
+            messages.append(event)
+
+        if not messages:
             return jsonify({"status": "ignored"}), 200
 
-        logging.info(f"WhatsApp message: {message}")
+        busy = False
 
-        try:
+        for user_id, name, message, message_ids in coalesce_messages(messages):
 
-            reply = generate_reply(
-                "whatsapp",
-                user_id,
-                name,
-                message
-            )
+            logging.info(f"WhatsApp message: {message}")
 
-        except Exception as e:
+            # Ack right away; Meta retries slow webhooks. A full queue
+            # answers 503 so the delivery is retried later instead of lost.
+            if not inbound_dispatcher.submit(user_id, name, message):
 
-            logging.error(e)
-            reply = "Hmm… thoda issue aa gaya. Ek baar phir bolo?"
+                busy = True
 
-        time.sleep(random.uniform(1.5, 3.5))
+                for message_id in message_ids:
+                    if message_id:
+                        inbound_dedup.forget(message_id)
 
-        send_whatsapp_message(user_id, reply)
+        if busy:
+            return jsonify({"status": "busy"}), 503
 
-        return jsonify({"status": "ok"}), 200
+        return jsonify({"status": "queued"}), 200